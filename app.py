@@ -1,13 +1,34 @@
 import streamlit as st
 import google.generativeai as genai
+import json
 import os
-import base64
-from PIL import Image
+import re
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
+from types import SimpleNamespace
+
+import debrief
+import dispatch
+import llm
+import media
+import ratelimit
+import resilience
+import routing
+import store
+import telemetry
+import transcript
 
 # Configure Gemini API
 genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
 
+# Start of a debrief report section: a markdown heading or a bold rated line
+SECTION_START = re.compile(r"\n(?=#{1,6} |\*\*\S)")
+
+# Lobby tiles show a poster first and only load their video once visible or hovered
+LAZY_LOBBY_VIDEO = os.environ.get('CHRYSALIS_LAZY_VIDEO', '1') != '0'
+
 
 # Scenario 1 - Intense Experience
 INITIATE_PROMPT = """You are an AI role-playing a participant named "David." You are a 50-year-old male, 80 minutes post-ingestion. The experience has become overwhelming - things feel "creepy and dark." You've removed your eyeshades and headphones. Your primary emotion is fear mixed with a desire to stop the experience.
@@ -30,10 +51,7 @@ Opening Line: "Honestly, I'm just so glad to be here. I was listening to this po
 # Debrief prompts
 DEBRIEF_PROMPT = """You are a Senior Clinical Assessment Specialist providing feedback based on MAPS protocols.
 
-Analyze the session transcript and create an Adherence Feedback report.
-
-Transcript:
-{transcript}
+Analyze the session transcript that follows these instructions and create an Adherence Feedback report.
 
 ### Adherence Feedback
 **Scenario:** Intense Experience - Dosing Session
@@ -76,10 +94,7 @@ Remember to replace [Rate with 🟢/🟡/🔴] with appropriate emoji based on p
 
 DEBRIEF_PROMPT_2 = """You are a Senior Clinical Assessment Specialist providing feedback based on MAPS protocols.
 
-Analyze the session transcript and create an Adherence Feedback report.
-
-Transcript:
-{transcript}
+Analyze the session transcript that follows these instructions and create an Adherence Feedback report.
 
 ### Adherence Feedback
 **Scenario:** Integration Session - Therapeutic Touch
@@ -123,10 +138,7 @@ Remember to replace [Rate with 🟢/🟡/🔴] with appropriate emoji based on p
 
 DEBRIEF_PROMPT_3 = """You are a Senior Clinical Assessment Specialist providing feedback based on MAPS protocols.
 
-Analyze the session transcript and create an Adherence Feedback report.
-
-Transcript:
-{transcript}
+Analyze the session transcript that follows these instructions and create an Adherence Feedback report.
 
 ### Adherence Feedback
 **Scenario:** Preparation - Managing Expectations
@@ -167,6 +179,41 @@ Transcript:
 Remember to replace [Rate with 🟢/🟡/🔴] with appropriate emoji based on performance.
 """
 
+PERSONAS = {1: "David", 2: "Alex", 3: "Bruce"}
+SCENARIO_NAMES = {
+    1: "Intense Experience - Dosing Session",
+    2: "Integration Session - Therapeutic Touch",
+    3: "Preparation Session - Managing Expectations",
+}
+INITIATE_PROMPTS = {1: INITIATE_PROMPT, 2: INITIATE_PROMPT_2, 3: INITIATE_PROMPT_3}
+# Spoken by the persona when the scenario starts (as in each INITIATE_PROMPT)
+OPENING_LINES = {
+    1: "This is too much. Everything feels creepy and dark. What can you give me to stop this from happening?",
+    2: "Hey... so, before we get into everything else... I just wanted to say I feel kind of embarrassed about yesterday. You know, when I asked for that hug. I know I said before that I wasn't a touchy person.",
+    3: "Honestly, I'm just so glad to be here. I was listening to this podcast, and it just clicked. I really think this is the thing that's finally going to re-wire my brain and cure this depression I've been fighting for so long.",
+}
+# Models per call type and scenario are chosen in routing.py
+
+# Folds older turns of a long session into a running summary (see transcript.py)
+SUMMARY_PROMPT = """You maintain a running summary of a psychedelic-assisted therapy training role-play between a therapist trainee ("Therapist") and a simulated client.
+
+You will be given the summary so far and the next part of the conversation. Rewrite the summary so it also covers the new part. Keep it under 200 words, in the third person, and preserve:
+- What the client disclosed and how their emotional state changed
+- What the therapist did (validation, grounding, psychoeducation, boundaries, consent) with short quotes of key therapist lines
+- Any commitments, open questions or safety concerns
+
+Respond with the summary only."""
+# Estimated tokens of conversation (summary + verbatim turns) sent per call, by scenario
+CONTEXT_TOKEN_BUDGETS = {1: 3000, 2: 4000, 3: 4000}
+
+# Usernames that may open the Usage & Capacity view (comma separated; none unless configured,
+# since logins are not password-checked)
+ADMIN_USERS = {name.strip() for name in os.environ.get('CHRYSALIS_ADMIN_USERS', '').split(',') if name.strip()}
+
+# Bump whenever a DEBRIEF_PROMPT changes so cached debriefs are regenerated.
+# The prompts are static rubrics sent as a (cacheable) prefix; the transcript goes last.
+DEBRIEF_PROMPT_VERSION = 2
+
 
 # Initialize session state
 if 'logged_in' not in st.session_state:
@@ -181,29 +228,159 @@ if 'show_debrief' not in st.session_state:
     st.session_state.show_debrief = False
 if 'current_scenario' not in st.session_state:
     st.session_state.current_scenario = 1
-if 'model' not in st.session_state:
-    st.session_state.model = genai.GenerativeModel('gemini-1.5-flash')
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if 'username' not in st.session_state:
+    st.session_state.username = ''
+
+
+def show_video(path, slot, width, height, style):
+    """Renders a looping muted video served from the asset server"""
+    src = media.asset_url(media.rendition(path, slot))
+    if src:
+        st.markdown(
+            f"""
+            <video width="{width}" height="{height}" style="{style}" autoplay loop muted playsinline>
+                <source src="{src}" type="video/mp4">
+            </video>
+            """,
+            unsafe_allow_html=True
+        )
+
+
+def show_lazy_video(path, slot, height_px):
+    """Renders a poster that swaps in its looping video once in view or hovered"""
+    src = media.asset_url(media.rendition(path, slot))
+    if not src:
+        return
+    if src.startswith("data:"):
+        # Inlined anyway: deferring playback would not save shipping or parsing it
+        show_video(path, slot, width="100%", height=f"{height_px}px", style="object-fit: cover; border-radius: 10px;")
+        return
+    poster_path = media.poster(path)
+    if poster_path:
+        attrs = f'poster="{media.asset_url(poster_path)}" preload="none"'
+    else:
+        # No built poster: fetch just enough of the video to show its first frame
+        attrs = 'preload="metadata"'
+    video_id = "tile-" + os.path.splitext(os.path.basename(path))[0]
+    st.html(
+        f"""
+        <video id="{video_id}" width="100%" height="{height_px}px" {attrs} loop muted playsinline
+               data-src="{src}" style="object-fit: cover; border-radius: 10px; background: #2b2b3e;"></video>
+        <script>
+        (() => {{
+            const video = document.getElementById("{video_id}");
+            const attach = () => {{
+                if (video.src) return;
+                video.src = video.dataset.src;
+                video.play().catch(() => {{}});
+            }};
+            video.addEventListener("mouseenter", attach);
+            // Let first paint finish before any tile starts decoding
+            const idle = window.requestIdleCallback || ((cb) => setTimeout(cb, 200));
+            new IntersectionObserver((entries, observer) => {{
+                if (entries.some((e) => e.isIntersecting)) {{
+                    observer.disconnect();
+                    idle(attach);
+                }}
+            }}).observe(video);
+        }})();
+        </script>
+        """,
+        unsafe_allow_javascript=True,
+    )
+
+
+def show_lobby_tile(path):
+    if LAZY_LOBBY_VIDEO:
+        show_lazy_video(path, "tile", 200)
+    else:
+        show_video(path, "tile", width="100%", height="200px", style="object-fit: cover; border-radius: 10px;")
+
+
+def start_scenario(scenario):
+    """Opens a persona chat seeded with its opening line (no network call)"""
+    st.session_state.current_screen = 'dojo'
+    st.session_state.current_scenario = scenario
+    st.session_state.scenario_active = True
+    st.session_state.show_debrief = False
+    opening_line = OPENING_LINES[scenario]
+    st.session_state.chat_history = [(PERSONAS[scenario], opening_line)]
+    st.session_state.context = transcript.RollingTranscript(transcript.CONTEXT_KEEP_TURNS, CONTEXT_TOKEN_BUDGETS[scenario])
+    model_name = routing.get_router().choose(scenario, "persona")
+    st.session_state.chat = persona_chat(model_name, st.session_state.chat_history)
+    # Persist the session and keep its id in the URL so a refresh can resume it
+    if 'dojo_id' in st.session_state:
+        store.get_store().end_session(st.session_state.dojo_id, "abandoned")
+    st.session_state.dojo_id = uuid.uuid4().hex
+    store.get_store().start_session(st.session_state.dojo_id, st.session_state.username, scenario, PERSONAS[scenario], opening_line)
+    st.query_params["sid"] = st.session_state.dojo_id
+
+
+def resume_session(session_id):
+    """Restores one of the logged-in user's stored dojo sessions after a refresh or server restart"""
+    sessions = store.get_store()
+    record = sessions.get_session(session_id)
+    if record is None or record["status"] not in ("active", "completed"):
+        return False
+    if record["user"] != st.session_state.username:
+        # A session id is not a credential: only its owner picks it up
+        return False
+    scenario = record["scenario"]
+    st.session_state.current_screen = 'dojo'
+    st.session_state.current_scenario = scenario
+    st.session_state.dojo_id = session_id
+    st.session_state.chat_history = [(turn["speaker"], turn["text"]) for turn in sessions.turns(session_id)]
+    context = transcript.RollingTranscript(transcript.CONTEXT_KEEP_TURNS, CONTEXT_TOKEN_BUDGETS[scenario])
+    context.summary, context.folded = record["summary"], record["folded"]
+    st.session_state.context = context
+    st.session_state.chat = persona_chat(routing.get_router().choose(scenario, "persona"), st.session_state.chat_history)
+    st.session_state.scenario_active = record["status"] == "active"
+    st.session_state.show_debrief = record["status"] == "completed"
+    saved = sessions.debrief(session_id)
+    if saved and saved["prompt_version"] == DEBRIEF_PROMPT_VERSION:
+        debrief.store_report(current_debrief_key(), saved["report"])
+    st.query_params["sid"] = session_id
+    return True
+
+
+def leave_session():
+    """Forgets the current dojo session in this browser (it stays in the store)"""
+    st.session_state.pop('dojo_id', None)
+    st.query_params.pop("sid", None)
+
+
+def persona_chat(model_name, history):
+    """A persona chat on model_name seeded from the app's chat history"""
+    # The persona prompt is the system instruction of a model shared by all sessions
+    model = llm.get_model(model_name, system_instruction=INITIATE_PROMPTS[st.session_state.current_scenario])
+    st.session_state.chat_model = model_name
+    return model.start_chat(history=st.session_state.context.chat_history(history))
 
 
 def show_login():
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        if os.path.exists("assets/chrysalis-logo.png"):
-            st.image("assets/chrysalis-logo.png", width=400)
+        logo = media.thumbnail("assets/chrysalis-logo.png", 400)
+        if logo:
+            st.image(logo, width=400)
         st.markdown("### Login to Continue")
         username = st.text_input("Username")
         password = st.text_input("Password", type="password")
         
         if st.button("Login", use_container_width=True):
             st.session_state.logged_in = True
+            st.session_state.username = username.strip() or 'guest'
             st.session_state.current_screen = 'lobby'
             st.rerun()
 
 def show_header():
     col1, col2, col3 = st.columns([2, 5, 1])
     with col1:
-        if os.path.exists("assets/chrysalis-logo.png"):
-            st.image("assets/chrysalis-logo.png", width=250)
+        logo = media.thumbnail("assets/chrysalis-logo.png", 250)
+        if logo:
+            st.image(logo, width=250)
     with col2:
         st.markdown("")
     with col3:
@@ -212,8 +389,9 @@ def show_header():
 def show_sidebar():
     with st.sidebar:
         # Add logo at top of sidebar if square version exists
-        if os.path.exists("assets/chrysalis-logo-square.jpg"):
-            st.image("assets/chrysalis-logo-square.jpg", width=120)
+        logo = media.thumbnail("assets/chrysalis-logo-square.jpg", 120)
+        if logo:
+            st.image(logo, width=120)
             st.markdown("---")
         
         st.markdown("### Navigation")
@@ -223,11 +401,71 @@ def show_sidebar():
             st.rerun()
         if st.button("📚 Learning History", use_container_width=True):
             st.session_state.current_screen = 'history'
+            st.session_state.pop('history_pages', None)
             st.rerun()
+        if st.session_state.username in ADMIN_USERS:
+            if st.button("📈 Usage & Capacity", use_container_width=True):
+                st.session_state.current_screen = 'admin'
+                st.rerun()
         st.markdown("◇ Settings")
         st.markdown("◌ Logout")
 
 
+def progress_rows(scenario_totals):
+    """Per-scenario table rows with the rating histogram"""
+    return [
+        {
+            "Scenario": SCENARIO_NAMES.get(scenario, str(scenario)),
+            "Sessions": totals['sessions'],
+            "Minutes": round(totals['seconds'] / 60),
+            "🟢": totals['green'],
+            "🟡": totals['yellow'],
+            "🔴": totals['red'],
+        }
+        for scenario, totals in sorted(scenario_totals.items())
+    ]
+
+
+def show_progress(sessions, user):
+    """Progress metrics for a user (or store.COHORT), read from the maintained aggregates"""
+    totals = sessions.totals(user)
+    recent = sessions.recent_totals(user, days=30)
+    total_minutes = totals['seconds'] / 60
+    rated = totals['green'] + totals['yellow'] + totals['red']
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Total Sessions", totals['sessions'], delta=f"{recent['sessions']} in 30 days", delta_color="off")
+    with col2:
+        excellent = totals['green']
+        share = f" ({excellent / rated * 100:.0f}%)" if rated else ""
+        st.metric("Excellent Sessions", f"{excellent}{share}", delta=f"{recent['green']} in 30 days", delta_color="off")
+    with col3:
+        st.metric("Total Practice Time", f"{total_minutes:.0f} min",
+                  delta=f"{recent['seconds'] / 60:.0f} min in 30 days", delta_color="off")
+    with col4:
+        avg = total_minutes / totals['sessions'] if totals['sessions'] else 0
+        st.metric("Avg Session Length", f"{avg:.0f} min")
+    
+    rows = progress_rows(sessions.scenario_totals(user))
+    if rows:
+        st.dataframe(rows, hide_index=True)
+
+
+def show_search(sessions, user, query, scenario=None):
+    """Ranked full-text matches with snippets"""
+    started = time.perf_counter()
+    results = sessions.search(user, query, scenario)
+    elapsed = (time.perf_counter() - started) * 1000
+    if not results:
+        st.info("No matches in your completed sessions.")
+        return
+    st.caption(f"{len(results)} best matches ({elapsed:.0f} ms)")
+    for result in results:
+        date = datetime.fromtimestamp(result['started_at']).strftime('%b %d, %Y')
+        st.markdown(f"**{SCENARIO_NAMES.get(result['scenario'], result['scenario'])}** · {date} · {result['speaker']}")
+        st.markdown("> " + " ".join(result['snippet'].split()))
+
+
 def show_history():
     """Display learning history"""
     show_header()
@@ -236,67 +474,404 @@ def show_history():
     st.markdown("# 📚 Learning History")
     st.markdown("Review your completed training sessions.")
     
-    from datetime import datetime, timedelta
-    import random
-    
-    sessions = []
-    base_date = datetime.now()
-    scenario_names = {
-        1: "Intense Experience - Dosing Session",
-        2: "Integration Session - Therapeutic Touch", 
-        3: "Preparation Session - Managing Expectations"
-    }
+    sessions = store.get_store()
+    user = st.session_state.username
     
-    summaries = {
-        1: ["Strong crisis response", "Good validation techniques", "Excellent clinical judgment"],
-        2: ["Created safety container", "Good integration skills", "Strong therapeutic presence"],
-        3: ["Managed expectations well", "Good psychoeducation", "Excellent collaborative stance"]
-    }
-    
-    for i in range(15):
-        scenario = (i % 3) + 1
-        sessions.append({
-            'id': 15-i,
-            'scenario': scenario,
-            'title': scenario_names[scenario],
-            'date': base_date - timedelta(days=random.randint(1,30)),
-            'summary': random.choice(summaries[scenario]),
-            'duration': random.randint(15,35),
-            'rating': random.choice(['🟢', '🟢', '🟡'])
-        })
-    
-    sessions.sort(key=lambda x: x['date'], reverse=True)
-    
-    # Progress Summary
     st.markdown("### 📊 Your Progress Summary")
-    col1, col2, col3, col4 = st.columns(4)
-    with col1:
-        st.metric("Total Sessions", 15)
-    with col2:
-        excellent = len([s for s in sessions if s['rating'] == '🟢'])
-        st.metric("Excellent Sessions", f"{excellent} ({excellent/15*100:.0f}%)")
-    with col3:
-        st.metric("Total Practice Time", "375 min")
-    with col4:
-        st.metric("Avg Session Length", "25 min")
+    show_progress(sessions, user)
     
     st.markdown("---")
     st.markdown("### Recent Sessions")
     
-    for session in sessions:
+    options = [None] + list(SCENARIO_NAMES)
+    scenario = st.selectbox(
+        "Scenario", options, format_func=lambda n: "All scenarios" if n is None else SCENARIO_NAMES[n],
+        key="history_scenario", on_change=lambda: st.session_state.pop('history_pages', None)
+    )
+    query = st.text_input("🔍 Search your transcripts and feedback", key="history_search",
+                          placeholder="e.g. grounding")
+    if query.strip():
+        show_search(sessions, user, query, scenario)
+        return
+    
+    # Keyset pagination: the (started_at, id) cursor each visited page started after
+    pages = st.session_state.setdefault('history_pages', [None])
+    page = sessions.history(user, scenario, before=pages[-1], limit=store.HISTORY_PAGE_SIZE + 1)
+    has_older = len(page) > store.HISTORY_PAGE_SIZE
+    page = page[:store.HISTORY_PAGE_SIZE]
+    
+    if not page:
+        st.info("No completed sessions yet. Finish a scenario in the lobby and it will show up here.")
+    
+    for session in page:
         col1, col2, col3, col4, col5 = st.columns([0.5, 2.5, 1.5, 2.5, 1])
         with col1:
-            st.markdown(session['rating'])
+            st.markdown(session['rating'] or "⚪")
         with col2:
-            st.markdown(f"**{session['title']}**")
-            st.caption(f"{session['duration']} min")
+            st.markdown(f"**{SCENARIO_NAMES[session['scenario']]}**")
+            st.caption(f"{max(1, round((session['ended_at'] - session['started_at']) / 60))} min")
         with col3:
-            st.markdown(session['date'].strftime('%b %d, %Y'))
+            st.markdown(datetime.fromtimestamp(session['started_at']).strftime('%b %d, %Y'))
         with col4:
-            st.caption(session['summary'])
+            st.caption(session['headline'] or f"{session['turn_count']} messages")
         with col5:
-            st.button("View", key=f"v{session['id']}")
+            if st.button("View", key=f"v{session['id']}"):
+                open_replay(session['id'])
+                st.rerun()
         st.markdown("---")
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if len(pages) > 1 and st.button("← Newer", use_container_width=True):
+            pages.pop()
+            st.rerun()
+    with col3:
+        if has_older and st.button("Older →", use_container_width=True):
+            last = page[-1]
+            pages.append((last['started_at'], last['id']))
+            st.rerun()
+
+
+def open_replay(session_id):
+    """Switches to the replay of one stored session, starting at its first turn"""
+    st.session_state.replay_id = session_id
+    # Keyset pagination: the seq each visited page of turns started after
+    st.session_state.replay_pages = [-1]
+    st.session_state.current_screen = 'replay'
+
+
+def show_replay():
+    """Transcript and debrief of one finished session, fetched a page at a time"""
+    show_header()
+    show_sidebar()
+    
+    sessions = store.get_store()
+    session = sessions.get_session(st.session_state.get('replay_id'))
+    if st.button("← Back to Learning History"):
+        st.session_state.current_screen = 'history'
+        st.rerun()
+    if session is None or (session['user'] != st.session_state.username
+                           and st.session_state.username not in ADMIN_USERS):
+        st.warning("That session could not be found.")
+        return
+    
+    ended = session['ended_at'] or session['updated_at']
+    st.markdown(f"# {session['rating'] or '⚪'} {SCENARIO_NAMES[session['scenario']]}")
+    st.caption(f"{datetime.fromtimestamp(session['started_at']).strftime('%b %d, %Y %H:%M')} · "
+               f"{max(1, round((ended - session['started_at']) / 60))} min · {session['turn_count']} messages")
+    
+    st.markdown("### Transcript")
+    pages = st.session_state.setdefault('replay_pages', [-1])
+    turns = sessions.turns_page(session['id'], after=pages[-1], limit=store.REPLAY_PAGE_SIZE + 1)
+    has_later = len(turns) > store.REPLAY_PAGE_SIZE
+    turns = turns[:store.REPLAY_PAGE_SIZE]
+    for turn in turns:
+        if turn['speaker'] == "Therapist":
+            st.markdown(f"**› You:** {turn['text']}")
+        else:
+            st.markdown(f"**‹ {turn['speaker']}:** {turn['text']}")
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if len(pages) > 1 and st.button("← Earlier", use_container_width=True):
+            pages.pop()
+            st.rerun()
+    with col3:
+        if has_later and st.button("Later →", use_container_width=True):
+            pages.append(turns[-1]['seq'])
+            st.rerun()
+    
+    st.markdown("---")
+    report = sessions.debrief(session['id'])
+    if report is None:
+        st.info("No debrief was generated for this session.")
+    else:
+        # The report brings its own "Adherence Feedback" heading
+        st.markdown(report['report'])
+
+
+def service_stats():
+    """Load, quota, breaker and cache state of this server process"""
+    prompt_cache = getattr(llm.get_backend(), "prompt_cache", None)
+    return {
+        "dispatcher": dispatch.get_dispatcher().stats(),
+        "rate_limiter": ratelimit.get_rate_limiter().stats(),
+        "breakers": resilience.breaker_stats(),
+        "debrief_cache": debrief.get_debrief_cache().stats(),
+        "asset_cache": media.get_asset_cache().stats(),
+        "prompt_cache": prompt_cache.stats() if prompt_cache else None,
+        "routing": routing.get_router().stats(),
+        "store": store.get_store().stats(),
+    }
+
+
+def show_admin():
+    """Token usage, latency and service health for capacity planning"""
+    show_header()
+    show_sidebar()
+    
+    st.markdown("# 📈 Usage & Capacity")
+    st.markdown("Model calls recorded in the session store.")
+    
+    tracker = telemetry.get_telemetry()
+    scenarios = tracker.scenarios()
+    
+    def ms(seconds):
+        return round(seconds * 1000) if seconds is not None else None
+    
+    st.markdown("### Per Scenario")
+    if not scenarios:
+        st.info("No model calls recorded yet.")
+    else:
+        st.dataframe([
+            {
+                "Scenario": SCENARIO_NAMES.get(scenario, str(scenario)),
+                "Sessions": totals["sessions"],
+                "Calls": totals["calls"],
+                "Errors": totals["errors"],
+                "Prompt tokens": totals["prompt_tokens"],
+                "Cached tokens": totals["cached_tokens"],
+                "Output tokens": totals["output_tokens"],
+                "Tokens / session": round(totals["tokens_per_session"]),
+                "Latency p50 (ms)": ms(totals["latency_p50"]),
+                "Latency p95 (ms)": ms(totals["latency_p95"]),
+                "TTFT p50 (ms)": ms(totals["ttft_p50"]),
+                "TTFT p95 (ms)": ms(totals["ttft_p95"]),
+                "Calls by kind": ", ".join(f"{kind}: {n}" for kind, n in sorted(totals["by_kind"].items())),
+            }
+            for scenario, totals in scenarios.items()
+        ], hide_index=True)
+    
+    st.markdown("### Cohort Progress")
+    st.caption("Completed sessions across all trainees.")
+    show_progress(store.get_store(), store.COHORT)
+    
+    cohort_query = st.text_input("🔍 Search all trainees' sessions", key="cohort_search")
+    if cohort_query.strip():
+        show_search(store.get_store(), store.COHORT, cohort_query)
+    
+    st.markdown("### Largest Sessions")
+    st.caption("Sessions with the most tokens; a climbing max prompt size points at a runaway transcript.")
+    st.dataframe([
+        dict(row, scenario=SCENARIO_NAMES.get(row["scenario"], row["scenario"]))
+        for row in tracker.session_totals(limit=10)
+    ], hide_index=True)
+    
+    stats = service_stats()
+    st.markdown("### Service Health")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**Dispatcher**")
+        st.json(stats["dispatcher"])
+        st.markdown("**Rate limiter**")
+        st.json(stats["rate_limiter"])
+    with col2:
+        st.markdown("**Circuit breakers**")
+        st.json(stats["breakers"])
+        st.markdown("**Model routing**")
+        st.json(stats["routing"])
+        st.markdown("**Session store**")
+        st.json(stats["store"])
+        st.markdown("**Caches**")
+        st.json({"debrief": stats["debrief_cache"], "assets": stats["asset_cache"], "prompts": stats["prompt_cache"]})
+    
+    export = dict(tracker.export(), services=stats)
+    st.download_button(
+        "⬇️ Export telemetry (JSON)",
+        data=json.dumps(export, indent=2, default=str),
+        file_name=f"chrysalis-telemetry-{datetime.now():%Y%m%d-%H%M%S}.json",
+        mime="application/json",
+    )
+
+
+@contextmanager
+def model_slot(estimated_tokens, kind):
+    """Waits for a model-call slot and quota, showing the trainee why they wait
+    
+    Yields a call record; set its `response` so the quota can be settled with
+    the real token count once the call is done, and `record.model` to the
+    model that answered. Tokens and timings are recorded under `kind` for the
+    Usage & Capacity view.
+    """
+    queued_at = time.monotonic()
+    status = st.empty()
+    
+    def on_wait(position):
+        status.caption(f"⏳ The simulator is busy — you are #{position} in the queue...")
+    
+    api_key = os.environ.get('GEMINI_API_KEY')
+    limiter = ratelimit.get_rate_limiter()
+    # Queues are per trainee, so several tabs of one user share a turn
+    with dispatch.get_dispatcher().slot(st.session_state.username, on_wait):
+        wait = limiter.reserve(api_key, estimated_tokens)
+        if wait > 0:
+            status.caption("⏳ Pacing requests to stay within the API quota...")
+            time.sleep(wait)
+        status.empty()
+        # pace() re-reserves quota before a retry
+        call = SimpleNamespace(response=None, pace=lambda: limiter.acquire(api_key, estimated_tokens))
+        with telemetry.get_telemetry().track(st.session_state.get('dojo_id', st.session_state.session_id), st.session_state.current_scenario,
+                                             kind, None, time.monotonic() - queued_at) as call.record:
+            yield call
+            call.record.response = call.response
+    limiter.settle(api_key, estimated_tokens, prompt_tokens(call.response))
+
+
+def prompt_tokens(response):
+    """Input tokens actually billed for a (finished) response, if reported"""
+    usage = getattr(response, "usage_metadata", None)
+    return usage.prompt_token_count if usage else None
+
+
+def stream_text(response, record=None):
+    """Yields the text of a streamed Gemini response chunk by chunk"""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks carrying only finish/safety metadata have no text
+            continue
+        if record is not None:
+            record.first_token()
+        yield text
+
+
+def stopped_early(response):
+    """Finish reason of a fully streamed reply that did not complete normally (e.g. "SAFETY"), else None"""
+    candidates = getattr(response, "candidates", None)
+    if candidates is None:
+        return None
+    if not candidates:
+        return "BLOCKED"
+    reason = candidates[0].finish_reason
+    name = getattr(reason, "name", str(reason))
+    return None if name in ("STOP", "MAX_TOKENS") else name
+
+
+# A persona reply the model refused or cut off; the chat must drop the exchange to continue
+REPLY_STOPPED = (genai.types.StopCandidateException, genai.types.BlockedPromptException,
+                 genai.types.BrokenResponseError)
+
+
+def stream_sections(texts):
+    """Regroups streamed text into whole report sections (split at headings)"""
+    buffer = ""
+    for text in texts:
+        buffer += text
+        starts = [m.start() for m in SECTION_START.finditer(buffer) if m.start() > 0]
+        if starts:
+            yield buffer[:starts[-1]]
+            buffer = buffer[starts[-1]:]
+    if buffer:
+        yield buffer
+
+
+def session_transcript():
+    return transcript.format_turns(st.session_state.chat_history)
+
+
+def prompt_transcript():
+    """The transcript as sent to a model: older turns summarized in long sessions"""
+    if 'context' not in st.session_state:
+        return session_transcript()
+    return st.session_state.context.render(st.session_state.chat_history)
+
+
+def summarizer():
+    """Summary updater for transcript.RollingTranscript.fold (runs off the script thread)"""
+    session_id = st.session_state.session_id
+    dojo_id = st.session_state.get('dojo_id', session_id)
+    user = st.session_state.username
+    scenario = st.session_state.current_scenario
+    tracker = telemetry.get_telemetry()
+    dispatcher = dispatch.get_dispatcher()
+    limiter = ratelimit.get_rate_limiter()
+    router = routing.get_router()
+    api_key = os.environ.get('GEMINI_API_KEY')
+    
+    def summarize(previous, turns):
+        prompt = f"Summary so far:\n{previous or '(none yet)'}\n\nNext part of the conversation:\n{transcript.format_turns(turns)}"
+        estimate = ratelimit.estimate_tokens(SUMMARY_PROMPT, prompt)
+        queued_at = time.monotonic()
+        with dispatcher.slot(user):
+            limiter.acquire(api_key, estimate)
+            with tracker.track(dojo_id, scenario, "summary", None, time.monotonic() - queued_at) as record:
+                record.model, record.response = router.call(
+                    scenario, "summary",
+                    lambda model_name, timeout: llm.get_model(model_name, system_instruction=SUMMARY_PROMPT).generate_content(
+                        prompt, request_options=resilience.request_options(timeout)),
+                    on_retry=lambda: limiter.acquire(api_key, estimate)
+                )
+        response = record.response
+        limiter.settle(api_key, estimate, prompt_tokens(response))
+        return response.text.strip()
+    
+    return summarize
+
+
+def refresh_chat():
+    """Rebuilds the persona chat from summary + recent turns once a new summary is ready"""
+    context = st.session_state.get('context')
+    if context is not None and context.apply():
+        st.session_state.chat = persona_chat(st.session_state.chat_model, st.session_state.chat_history)
+        if 'dojo_id' in st.session_state:
+            store.get_store().save_context(st.session_state.dojo_id, context.summary, context.folded)
+
+
+def debrief_prompt_for(scenario):
+    if scenario == 1:
+        return DEBRIEF_PROMPT
+    elif scenario == 2:
+        return DEBRIEF_PROMPT_2
+    else:
+        return DEBRIEF_PROMPT_3
+
+
+def debrief_contents():
+    """The variable part of a debrief request, sent after the rubric prefix"""
+    return f"Transcript:\n{prompt_transcript()}"
+
+
+def current_debrief_key():
+    scenario = st.session_state.current_scenario
+    # Reports are cached under the primary model, whichever model ends up writing them
+    primary = routing.get_router().route(scenario, "debrief").primary
+    return debrief.debrief_key(scenario, DEBRIEF_PROMPT_VERSION, primary, session_transcript())
+
+
+def draft_debrief():
+    """Drafts the debrief for the transcript-so-far in the background"""
+    scenario = st.session_state.current_scenario
+    router = routing.get_router()
+    key = current_debrief_key()
+    rubric = debrief_prompt_for(scenario)
+    contents = debrief_contents()
+    session_id = st.session_state.session_id
+    dojo_id = st.session_state.get('dojo_id', session_id)
+    user = st.session_state.username
+    dispatcher = dispatch.get_dispatcher()
+    limiter = ratelimit.get_rate_limiter()
+    api_key = os.environ.get('GEMINI_API_KEY')
+    estimate = ratelimit.estimate_tokens(rubric, contents)
+    
+    tracker = telemetry.get_telemetry()
+    
+    def generate():
+        queued_at = time.monotonic()
+        with dispatcher.slot(user):
+            limiter.acquire(api_key, estimate)
+            with tracker.track(dojo_id, scenario, "debrief_draft", None, time.monotonic() - queued_at) as record:
+                record.model, record.response = router.call(
+                    scenario, "debrief",
+                    lambda model_name, timeout: llm.get_prefixed_model(model_name, rubric).generate_content(
+                        contents, request_options=resilience.request_options(timeout)),
+                    on_retry=lambda: limiter.acquire(api_key, estimate)
+                )
+        response = record.response
+        limiter.settle(api_key, estimate, prompt_tokens(response))
+        return response.text
+    
+    debrief.get_drafter().submit(session_id, key, generate)
 
 
 def show_dojo():
@@ -319,18 +894,7 @@ def show_dojo():
     else:
         video_file = "assets/scenario3c-new-video.mp4"
     
-    if os.path.exists(video_file):
-        with open(video_file, "rb") as f:
-            video_bytes = f.read()
-            video_b64 = base64.b64encode(video_bytes).decode()
-            st.markdown(
-                f"""
-                <video width="25%" height="auto" style="margin: 0; display: block;" autoplay loop muted playsinline>
-                    <source src="data:video/mp4;base64,{video_b64}" type="video/mp4">
-                </video>
-                """,
-                unsafe_allow_html=True
-            )
+    show_video(video_file, "dojo", width="25%", height="auto", style="margin: 0; display: block;")
     
     # Display prebrief summary
     st.markdown("")  # spacing
@@ -384,30 +948,56 @@ def show_dojo():
     if st.session_state.get('show_debrief', False):
         st.markdown("---")
         
-        # Generate transcript
-        transcript = "\n\n".join([f"{speaker}: {message}" for speaker, message in st.session_state.chat_history])
+        rubric = debrief_prompt_for(st.session_state.current_scenario)
         
-        # Select appropriate debrief prompt
-        if st.session_state.current_scenario == 1:
-            debrief_prompt = DEBRIEF_PROMPT
-        elif st.session_state.current_scenario == 2:
-            debrief_prompt = DEBRIEF_PROMPT_2
+        # Generate debrief (once per finished session; reruns reuse the report)
+        router = routing.get_router()
+        key = current_debrief_key()
+        report = debrief.cached_report(key)
+        if report is None and debrief.SPECULATIVE_DEBRIEF:
+            with st.spinner("📋 Finishing Adherence Feedback..."):
+                report = debrief.get_drafter().wait(st.session_state.session_id, key)
+            if report is not None:
+                debrief.store_report(key, report)
+        if report is not None:
+            st.markdown(report)
         else:
-            debrief_prompt = DEBRIEF_PROMPT_3
+            try:
+                contents = debrief_contents()
+                with model_slot(ratelimit.estimate_tokens(rubric, contents), "debrief") as call:
+                    with st.spinner("📋 Generating Adherence Feedback..."):
+                        # The rubric is a fixed prefix (cached provider-side when possible)
+                        call.record.model, call.response = router.call(
+                            st.session_state.current_scenario, "debrief",
+                            lambda model_name, timeout: llm.get_prefixed_model(model_name, rubric).generate_content(
+                                contents, stream=True, request_options=resilience.request_options(timeout)),
+                            on_retry=call.pace
+                        )
+                        debrief_response = call.response
+                    
+                    # Display the feedback one finished section at a time
+                    report = st.write_stream(stream_sections(stream_text(debrief_response, call.record)))
+                debrief.store_report(key, report)
+                st.session_state.debrief_model = call.record.model
+                
+            except resilience.CircuitOpenError:
+                st.warning("📋 Adherence Feedback is temporarily unavailable while the feedback service recovers. Please try again in a minute.")
+            except Exception as e:
+                st.error(f"Error generating debrief: {str(e)}")
         
-        # Generate debrief
-        try:
-            with st.spinner("📋 Generating Adherence Feedback..."):
-                debrief_model = genai.GenerativeModel('gemini-1.5-flash')
-                debrief_response = debrief_model.generate_content(
-                    debrief_prompt.format(transcript=transcript)
-                )
-            
-            # Display the feedback
-            st.markdown(debrief_response.text)
-            
-        except Exception as e:
-            st.error(f"Error generating debrief: {str(e)}")
+        # Keep the report with the stored session (once per session and report; identical
+        # transcripts from different sessions share a cache key)
+        saved = (st.session_state.get('dojo_id'), key)
+        if report is not None and 'dojo_id' in st.session_state and st.session_state.get('saved_debrief') != saved:
+            store.get_store().save_debrief(
+                st.session_state.dojo_id,
+                st.session_state.pop('debrief_model', None) or router.route(st.session_state.current_scenario, "debrief").primary,
+                DEBRIEF_PROMPT_VERSION,
+                report,
+                debrief.overall_rating(report),
+                debrief.headline(report)
+            )
+            st.session_state.saved_debrief = saved
         
         # Action buttons
         st.markdown("---")
@@ -434,6 +1024,8 @@ def show_dojo():
                 st.session_state.scenario_active = False
                 if 'chat' in st.session_state:
                     del st.session_state.chat
+                st.session_state.pop('context', None)
+                leave_session()
                 st.rerun()
         
         with col3:
@@ -441,6 +1033,7 @@ def show_dojo():
                 st.session_state.current_screen = 'lobby'
                 st.session_state.chat_history = []
                 st.session_state.show_debrief = False
+                leave_session()
                 st.rerun()
         
         # Don't show chat input during debrief
@@ -460,30 +1053,87 @@ def show_dojo():
         user_input = st.chat_input("Type your response and press Enter...")
         
         if user_input:
+            refresh_chat()
+            
             # Add therapist message
             st.session_state.chat_history.append(("Therapist", user_input))
+            st.markdown(f"**› You:** {user_input}")
             
-            # Get AI response
-            response = st.session_state.chat.send_message(user_input)
-            speaker_name = "David" if st.session_state.current_scenario == 1 else ("Alex" if st.session_state.current_scenario == 2 else "Bruce")
-            st.session_state.chat_history.append((speaker_name, response.text))
+            # Stream AI response into the chat as it is generated
+            speaker_name = PERSONAS[st.session_state.current_scenario]
+            reply_area = st.empty()
+            reply = ""
+            estimate = ratelimit.estimate_tokens(INITIATE_PROMPTS[st.session_state.current_scenario], prompt_transcript())
             
-            st.rerun()
+            def send(model_name, timeout):
+                if model_name != st.session_state.chat_model:
+                    # Routed to another model: carry the conversation over to it
+                    st.session_state.chat = persona_chat(model_name, st.session_state.chat_history[:-1])
+                return st.session_state.chat.send_message(user_input, stream=True, request_options=resilience.request_options(timeout))
+            
+            call = None
+            try:
+                with model_slot(estimate, "persona") as call:
+                    call.record.model, call.response = routing.get_router().call(
+                        st.session_state.current_scenario, "persona", send, on_retry=call.pace
+                    )
+                    for text in stream_text(call.response, call.record):
+                        reply += text
+                        reply_area.markdown(f"**‹ {speaker_name}:** {reply}▌")
+                    if stopped_early(call.response):
+                        # e.g. SAFETY: the partial reply must not be kept, or the chat refuses every later message
+                        raise genai.types.StopCandidateException(call.response.candidates[0])
+            except (resilience.CircuitOpenError, *resilience.TRANSIENT_ERRORS):
+                # Degraded mode: drop the unanswered message so it can be sent again
+                st.session_state.chat_history.pop()
+                if call is not None and call.response is not None:
+                    st.session_state.chat.rewind()
+                reply_area.warning(f"{speaker_name} can't respond right now — the simulator is under heavy load. Please wait a moment and send your message again.")
+            except REPLY_STOPPED:
+                st.session_state.chat_history.pop()
+                if call is not None and call.response is not None:
+                    st.session_state.chat.rewind()
+                else:
+                    # Stuck on an earlier broken reply, or refused before answering: start over from the transcript
+                    st.session_state.chat = persona_chat(st.session_state.chat_model, st.session_state.chat_history)
+                reply_area.warning(f"{speaker_name}'s reply was stopped by the model's safety filters. Please rephrase your message and send it again.")
+            except Exception as e:
+                # Not retryable (e.g. invalid request): keep the session usable and let the message be sent again
+                st.session_state.chat_history.pop()
+                if call is not None and call.response is not None:
+                    st.session_state.chat.rewind()
+                reply_area.error(f"Error getting {speaker_name}'s response: {str(e)}")
+            else:
+                reply_area.markdown(f"**‹ {speaker_name}:** {reply}")
+                st.session_state.chat_history.append((speaker_name, reply))
+                if 'dojo_id' in st.session_state:
+                    # Queued for the store's background writer; does not wait for the disk
+                    store.get_store().add_turns(st.session_state.dojo_id, len(st.session_state.chat_history) - 2,
+                                                st.session_state.chat_history[-2:])
+                
+                # Fold older turns into the summary in the background
+                if 'context' in st.session_state:
+                    st.session_state.context.fold(st.session_state.chat_history, summarizer())
+                
+                if debrief.SPECULATIVE_DEBRIEF:
+                    draft_debrief()
+                
+                st.rerun()
     
     # End session button in sidebar
     with st.sidebar:
         st.markdown("---")
         if st.button("◉ End Session & Debrief", type="primary", use_container_width=True):
             st.session_state.scenario_active = False
+            if 'dojo_id' in st.session_state:
+                store.get_store().end_session(st.session_state.dojo_id)
             st.session_state.show_debrief = True
             st.rerun()
 
 # Main app
 def main():
-    # Set favicon
-    favicon = "🦋"  # Default
-    if os.path.exists("assets/chrysalis-logo-square.jpg"):
-        favicon = Image.open("assets/chrysalis-logo-square.jpg")
+    # Set favicon (logos are decoded and resized once per process)
+    favicon = media.favicon() or "🦋"
     
     st.set_page_config(page_title="Chrysalis Therapist Training", page_icon=favicon, layout="wide")
     # Custom CSS for visual theme
@@ -533,12 +1183,23 @@ def main():
     """, unsafe_allow_html=True)
 
     
+    # A session id in the URL (refresh, restart) picks that session up again once its owner has logged in
+    if st.session_state.logged_in and 'resume_checked' not in st.session_state:
+        st.session_state.resume_checked = True
+        sid = st.query_params.get("sid")
+        if sid and sid != st.session_state.get('dojo_id') and not resume_session(sid):
+            st.query_params.pop("sid", None)
+    
     if not st.session_state.logged_in:
         show_login()
     elif st.session_state.current_screen == 'dojo':
         show_dojo()
     elif st.session_state.current_screen == 'history':
         show_history()
+    elif st.session_state.current_screen == 'replay':
+        show_replay()
+    elif st.session_state.current_screen == 'admin' and st.session_state.username in ADMIN_USERS:
+        show_admin()
     else:
         show_header()
         show_sidebar()
@@ -546,87 +1207,47 @@ def main():
         st.markdown("## Scenario Lobby")
         st.markdown("Select a training scenario to begin your practice session.")
         
+        unfinished = store.get_store().active_session(st.session_state.username)
+        if unfinished:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.info(f"You have an unfinished session: **{SCENARIO_NAMES[unfinished['scenario']]}** "
+                        f"({unfinished['turn_count']} messages).")
+            with col2:
+                if st.button("Resume Session", type="primary", use_container_width=True):
+                    resume_session(unfinished['id'])
+                    st.rerun()
+        
         col1, col2, col3 = st.columns(3)
         
         with col1:
             # Video for scenario 1
-            if os.path.exists("assets/scenario1-new-video.mp4"):
-                video_file = open("assets/scenario1-new-video.mp4", "rb")
-                video_bytes = video_file.read()
-                video_b64 = base64.b64encode(video_bytes).decode()
-                st.markdown(
-                    f"""
-                    <video width="100%" height="200px" autoplay loop muted playsinline style="object-fit: cover; border-radius: 10px;">
-                        <source src="data:video/mp4;base64,{video_b64}" type="video/mp4">
-                    </video>
-                    """,
-                    unsafe_allow_html=True
-                )
+            show_lobby_tile("assets/scenario1-new-video.mp4")
             st.markdown("")  # spacing
             st.markdown("### Intense Experience")
             st.markdown("Navigate a challenging experience with a participant wanting to stop their journey.")
             if st.button("Begin Scenario", key="scenario1"):
-                st.session_state.current_screen = 'dojo'
-                st.session_state.current_scenario = 1
-                st.session_state.scenario_active = True
-                chat = st.session_state.model.start_chat(history=[])
-                response = chat.send_message(INITIATE_PROMPT)
-                st.session_state.chat = chat
-                st.session_state.chat_history = [("David", "This is too much. Everything feels creepy and dark. What can you give me to stop this from happening?")]
+                start_scenario(1)
                 st.rerun()
                 
         with col2:
             # Video for scenario 2
-            if os.path.exists("assets/scenario2a-new-video.mp4"):
-                video_file = open("assets/scenario2a-new-video.mp4", "rb")
-                video_bytes = video_file.read()
-                video_b64 = base64.b64encode(video_bytes).decode()
-                st.markdown(
-                    f"""
-                    <video width="100%" height="200px" autoplay loop muted playsinline style="object-fit: cover; border-radius: 10px;">
-                        <source src="data:video/mp4;base64,{video_b64}" type="video/mp4">
-                    </video>
-                    """,
-                    unsafe_allow_html=True
-                )
+            show_lobby_tile("assets/scenario2a-new-video.mp4")
             st.markdown("")  # spacing
             st.markdown("### Integration Session: Therapeutic Touch")
             st.markdown("Process vulnerability and consent after physical comfort during dosing.")
             if st.button("Begin Scenario", key="scenario2"):
-                st.session_state.current_screen = 'dojo'
-                st.session_state.current_scenario = 2
-                st.session_state.scenario_active = True
-                chat = st.session_state.model.start_chat(history=[])
-                response = chat.send_message(INITIATE_PROMPT_2)
-                st.session_state.chat = chat
-                st.session_state.chat_history = [("Alex", "Hey... so, before we get into everything else... I just wanted to say I feel kind of embarrassed about yesterday. You know, when I asked for that hug. I know I said before that I wasn't a touchy person.")]
+                start_scenario(2)
                 st.rerun()
                 
         with col3:
             # Video for scenario 3
-            if os.path.exists("assets/scenario3c-new-video.mp4"):
-                video_file = open("assets/scenario3c-new-video.mp4", "rb")
-                video_bytes = video_file.read()
-                video_b64 = base64.b64encode(video_bytes).decode()
-                st.markdown(
-                    f"""
-                    <video width="100%" height="200px" autoplay loop muted playsinline style="object-fit: cover; border-radius: 10px;">
-                        <source src="data:video/mp4;base64,{video_b64}" type="video/mp4">
-                    </video>
-                    """,
-                    unsafe_allow_html=True
-                )
+            show_lobby_tile("assets/scenario3c-new-video.mp4")
             st.markdown("")  # spacing
             st.markdown("### Preparation: Managing Expectations")
             st.markdown("Guide a client with unrealistic expectations about psychedelic therapy.")
             if st.button("Begin Scenario", key="scenario3"):
-                st.session_state.current_screen = 'dojo'
-                st.session_state.current_scenario = 3
-                st.session_state.scenario_active = True
-                chat = st.session_state.model.start_chat(history=[])
-                response = chat.send_message(INITIATE_PROMPT_3)
-                st.session_state.chat = chat
-                st.session_state.chat_history = [("Bruce", "Honestly, I'm just so glad to be here. I was listening to this podcast, and it just clicked. I really think this is the thing that's finally going to re-wire my brain and cure this depression I've been fighting for so long.")]
+                start_scenario(3)
                 st.rerun()
         
         # Available Scenarios
@@ -1,9 +1,10 @@
 import streamlit as st
 import google.generativeai as genai
 from PIL import Image
-import base64
 import os
 
+import media
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="Chrysalis PAT Simulator",
@@ -28,12 +29,10 @@ except FileNotFoundError:
 
 # --- Helper Function for Videos ---
 def get_video_b64(path: str):
-    """Reads a video file and returns its base64 encoded string."""
+    """Returns a video's base64 encoded string from the shared asset cache."""
     if not os.path.exists(path):
         return None
-    with open(path, "rb") as f:
-        video_bytes = f.read()
-    return base64.b64encode(video_bytes).decode()
+    return media.get_asset_cache().get(path, media.encode_b64, "base64")
 
 # --- Session State Initialization ---
 if 'chat' not in st.session_state:
@@ -0,0 +1,178 @@
+"""Micro-benchmarks for the Chrysalis app's rerun path.
+
+Usage:
+    python bench.py images [--reruns 200]
+    python bench.py start [--runs 5]     # needs GEMINI_API_KEY
+    python bench.py load [--sessions 20] [--turns 5]   # offline, fake backend
+"""
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from streamlit.elements.lib.image_utils import image_to_url
+from streamlit.elements.lib.layout_utils import LayoutConfig
+
+import media
+
+# (image, displayed width) for everything drawn on a typical rerun
+RERUN_IMAGES = [
+    ("assets/chrysalis-logo.png", 250),          # show_header()
+    ("assets/chrysalis-logo-square.jpg", 120),   # show_sidebar()
+]
+
+
+def _time_reruns(reruns, render):
+    start = time.perf_counter()
+    for _ in range(reruns):
+        render()
+    return (time.perf_counter() - start) / reruns * 1000
+
+
+def bench_images(args):
+    from PIL import Image
+
+    def before():
+        # What the app did per rerun: hand paths to st.image / a PIL image to set_page_config
+        for path, width in RERUN_IMAGES:
+            image_to_url(path, LayoutConfig(width=width), False, "RGB", "auto", "bench")
+        image_to_url(Image.open(media.FAVICON_SOURCE), LayoutConfig(width="stretch"), False, "RGB", "auto", "bench")
+
+    def after():
+        for path, width in RERUN_IMAGES:
+            image_to_url(media.thumbnail(path, width), LayoutConfig(width=width), False, "RGB", "auto", "bench")
+        image_to_url(media.favicon(), LayoutConfig(width="stretch"), False, "RGB", "auto", "bench")
+
+    media.load_images()  # startup cost, paid once per process
+    before_ms = _time_reruns(args.reruns, before)
+    after_ms = _time_reruns(args.reruns, after)
+    print(f"image work per rerun: before {before_ms:.2f} ms, after {after_ms:.2f} ms "
+          f"({before_ms / after_ms:.1f}x faster)")
+
+
+def bench_start(args):
+    import google.generativeai as genai
+
+    import app
+    import routing
+
+    def before(scenario):
+        # Previous flow: prime a fresh chat with the persona prompt and discard the reply
+        chat = genai.GenerativeModel(routing.ROUTES["persona"].primary).start_chat(history=[])
+        chat.send_message(app.INITIATE_PROMPTS[scenario])
+
+    def after(scenario):
+        app.start_scenario(scenario)
+
+    for label, start in (("before", before), ("after", after)):
+        timings = []
+        for run in range(args.runs):
+            scenario = run % 3 + 1
+            t0 = time.perf_counter()
+            start(scenario)
+            timings.append((time.perf_counter() - t0) * 1000)
+        print(f"time to dojo {label}: median {statistics.median(timings):.1f} ms, max {max(timings):.1f} ms")
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _load_session(app_path, number, turns, timeout):
+    """One simulated trainee, run in its own process. Returns (turn_ms, debrief_ms, error)."""
+    from streamlit.testing.v1 import AppTest
+
+    turn_ms, debrief_ms = [], None
+    try:
+        at = AppTest.from_file(app_path, default_timeout=timeout)
+        at.run()
+        at.text_input[0].set_value(f"trainee{number}")
+        at.button[0].click().run()  # log in
+        at.button(key=f"scenario{number % 3 + 1}").click().run()
+        for turn in range(turns):
+            t0 = time.perf_counter()
+            at.chat_input[0].set_value(f"Trainee {number}, turn {turn}: what are you noticing?").run()
+            turn_ms.append((time.perf_counter() - t0) * 1000)
+        end = next(b for b in at.sidebar.button if "End Session" in b.label)
+        t0 = time.perf_counter()
+        end.click().run()
+        debrief_ms = (time.perf_counter() - t0) * 1000
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+    except Exception as exc:
+        return turn_ms, debrief_ms, f"{type(exc).__name__}: {exc}"
+    return turn_ms, debrief_ms, None
+
+
+def bench_load(args):
+    # Each session runs in its own process: AppTest keeps per-process singletons
+    # (the mock Runtime) and compiling the script from several threads at once
+    # trips a CPython AST bug. The processes share the fake backend settings and
+    # one session store, which is where they contend.
+    os.environ["CHRYSALIS_LLM_BACKEND"] = "fake"
+    workdir = tempfile.mkdtemp(prefix="chrysalis-bench-")
+    os.environ["CHRYSALIS_STORE_DB"] = os.path.join(workdir, "bench.db")
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    turn_ms, debrief_ms, errors = [], [], []
+    started = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.sessions, mp_context=context) as pool:
+        futures = {
+            pool.submit(_load_session, app_path, number, args.turns, args.timeout): number
+            for number in range(args.sessions)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                turns, debrief, error = future.result()
+            except Exception as exc:
+                turns, debrief, error = [], None, f"{type(exc).__name__}: {exc}"
+            turn_ms.extend(turns)
+            if debrief is not None:
+                debrief_ms.append(debrief)
+            if error:
+                errors.append(f"session {futures[future]}: {error}")
+    elapsed = time.perf_counter() - started
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    for label, timings in (("turn", turn_ms), ("debrief", debrief_ms)):
+        if timings:
+            print(f"{label}: n={len(timings)} p50 {_percentile(timings, 50):.0f} ms, "
+                  f"p95 {_percentile(timings, 95):.0f} ms, max {max(timings):.0f} ms")
+    print(f"{args.sessions} sessions in {elapsed:.1f} s, {len(errors)} failed")
+    for error in sorted(errors):
+        print(error)
+    # Non-zero exit so a CI job running the bench fails with the sessions
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the Chrysalis app")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    images = commands.add_parser("images", help="logo/favicon decoding and resizing per rerun")
+    images.add_argument("--reruns", type=int, default=200)
+    images.set_defaults(func=bench_images)
+
+    start = commands.add_parser("start", help="time from 'Begin Scenario' to a ready persona chat")
+    start.add_argument("--runs", type=int, default=5)
+    start.set_defaults(func=bench_start)
+
+    load = commands.add_parser("load", help="concurrent simulated sessions against the fake backend")
+    load.add_argument("--sessions", type=int, default=20)
+    load.add_argument("--turns", type=int, default=5)
+    load.add_argument("--timeout", type=float, default=60)
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Offline build step for the media under assets/.
+
+Transcodes every clip into smaller renditions sized for the slots the app
+actually uses and extracts a poster frame; identical sources share one set
+of outputs. Images are left alone, the app thumbnails those itself. The
+result is described by a manifest the app reads at startup.
+
+Usage:
+    python build_assets.py [--src assets] [--out assets/build] [--ffmpeg ffmpeg]
+
+Outputs are named after the source's content hash, so re-running only builds
+what changed.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Target widths: "small" covers the 200px lobby tiles and the 25%-width dojo
+# video, "medium" anything shown larger.
+RENDITION_WIDTHS = {"small": 480, "medium": 854}
+POSTER_WIDTH = RENDITION_WIDTHS["small"]
+POSTER_AT_SECONDS = 0.5
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".webm")
+
+
+def sha256_of(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def run_ffmpeg(ffmpeg, args):
+    subprocess.run([ffmpeg, "-y", "-loglevel", "error", *args], check=True)
+
+
+def build_video(src, digest, out_dir, ffmpeg):
+    entry = {"renditions": {}}
+    for name, width in RENDITION_WIDTHS.items():
+        target = f"{digest[:16]}-{name}.mp4"
+        if not os.path.exists(os.path.join(out_dir, target)):
+            run_ffmpeg(ffmpeg, [
+                "-i", src,
+                "-vf", f"scale='min({width},iw)':-2",
+                "-c:v", "libx264", "-preset", "slow", "-crf", "28", "-pix_fmt", "yuv420p",
+                # The lobby clips are always muted; moov atom first for fast start
+                "-an", "-movflags", "+faststart",
+                os.path.join(out_dir, target),
+            ])
+        entry["renditions"][name] = target
+
+    poster = f"{digest[:16]}-poster.jpg"
+    if not os.path.exists(os.path.join(out_dir, poster)):
+        run_ffmpeg(ffmpeg, [
+            "-ss", str(POSTER_AT_SECONDS), "-i", src,
+            "-frames:v", "1", "-vf", f"scale='min({POSTER_WIDTH},iw)':-2", "-q:v", "4",
+            os.path.join(out_dir, poster),
+        ])
+    entry["poster"] = poster
+    return entry
+
+
+def build(src_dir, out_dir, ffmpeg):
+    os.makedirs(out_dir, exist_ok=True)
+    have_ffmpeg = shutil.which(ffmpeg) is not None
+    if not have_ffmpeg:
+        print(f"warning: {ffmpeg} not found; nothing to build (the app will serve the sources)", file=sys.stderr)
+
+    built = {}
+    assets = {}
+    for name in sorted(os.listdir(src_dir)):
+        src = os.path.join(src_dir, name)
+        if not os.path.isfile(src):
+            continue
+        if os.path.splitext(name)[1].lower() not in VIDEO_EXTENSIONS:
+            continue
+        if not have_ffmpeg:
+            # A copy without renditions buys nothing over the source itself
+            print(f"skipped {src}")
+            continue
+        digest = sha256_of(src)
+
+        if digest not in built:
+            built[digest] = build_video(src, digest, out_dir, ffmpeg)
+            print(f"built {src}")
+        else:
+            print(f"deduplicated {src}")
+
+        assets[src.replace(os.sep, "/")] = dict(built[digest], sha256=digest)
+
+    manifest = {"version": MANIFEST_VERSION, "assets": assets}
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"wrote {len(assets)} assets ({len(built)} distinct) to {os.path.join(out_dir, MANIFEST_NAME)}")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--src", default="assets", help="directory holding the source media")
+    parser.add_argument("--out", default=os.path.join("assets", "build"), help="output directory")
+    parser.add_argument("--ffmpeg", default="ffmpeg", help="ffmpeg executable")
+    args = parser.parse_args(argv)
+    build(args.src, args.out, args.ffmpeg)
+
+
+if __name__ == "__main__":
+    main()
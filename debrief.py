@@ -0,0 +1,166 @@
+"""Caching of generated Adherence Feedback reports.
+
+Once a session is over, its debrief depends only on the scenario, the rubric
+prompt, the model and the transcript, so it is generated once and reused on
+every later rerun. Reports are kept in two tiers: the browser session (always
+hit on reruns) and a bounded process-wide cache shared by all sessions.
+
+With speculative drafting enabled, a background worker also drafts the report
+for the transcript-so-far after every exchange, so ending the session usually
+finds the report already done.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+# Number of reports kept in the process-wide tier
+DEBRIEF_CACHE_SIZE = int(os.environ.get("CHRYSALIS_DEBRIEF_CACHE_SIZE", "500"))
+# Opt-in: drafts cost one extra generation per exchange
+SPECULATIVE_DEBRIEF = os.environ.get("CHRYSALIS_SPECULATIVE_DEBRIEF", "0") == "1"
+SPECULATIVE_WORKERS = int(os.environ.get("CHRYSALIS_SPECULATIVE_WORKERS", "2"))
+# Longest End Session waits for a draft that is already being generated (seconds)
+DRAFT_WAIT = float(os.environ.get("CHRYSALIS_DRAFT_WAIT", "5"))
+
+
+RATING_SCORES = {"🟢": 2, "🟡": 1, "🔴": 0}
+RATED_LINE = re.compile(r"^\*\*\s*(🟢|🟡|🔴)", re.MULTILINE)
+RECOMMENDATION = re.compile(r"#### Specific Recommendations\s*\n\s*1\.\s*(.+)")
+
+
+def overall_rating(report):
+    """One 🟢/🟡/🔴 for a whole report, from its rated sections (None if unrated)."""
+    ratings = RATED_LINE.findall(report or "")
+    if not ratings:
+        return None
+    score = sum(RATING_SCORES[r] for r in ratings) / len(ratings)
+    return "🟢" if score >= 1.5 else "🟡" if score >= 0.75 else "🔴"
+
+
+def headline(report, limit=90):
+    """The report's first recommendation, shortened for list views."""
+    match = RECOMMENDATION.search(report or "")
+    if not match:
+        return ""
+    text = match.group(1).strip().strip("*")
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+def debrief_key(scenario, prompt_version, model_name, transcript):
+    transcript_hash = hashlib.sha256(transcript.encode("utf-8")).hexdigest()
+    return (scenario, prompt_version, model_name, transcript_hash)
+
+
+class DebriefCache:
+    """Thread-safe LRU of debrief reports keyed by debrief_key()."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._reports = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            report = self._reports.get(key)
+            if report is not None:
+                self._reports.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return report
+
+    def put(self, key, report):
+        with self._lock:
+            self._reports[key] = report
+            self._reports.move_to_end(key)
+            while len(self._reports) > self.max_entries:
+                self._reports.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._reports),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+@st.cache_resource
+def get_debrief_cache():
+    return DebriefCache(DEBRIEF_CACHE_SIZE)
+
+
+def cached_report(key):
+    """Returns a previously generated report from the session or process tier."""
+    session_reports = st.session_state.setdefault("debriefs", {})
+    report = session_reports.get(key)
+    if report is None:
+        report = get_debrief_cache().get(key)
+        if report is not None:
+            session_reports[key] = report
+    return report
+
+
+def store_report(key, report):
+    st.session_state.setdefault("debriefs", {})[key] = report
+    get_debrief_cache().put(key, report)
+
+
+class DebriefDrafter:
+    """Drafts debriefs in background threads while sessions are still running.
+
+    Each session has at most one draft queued or running. A newer transcript
+    replaces a draft that has not started yet, and a finished draft lands in
+    the process-wide cache under its debrief_key().
+    """
+
+    def __init__(self, cache, workers):
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="debrief-draft")
+        self._lock = threading.Lock()
+        self._drafts = {}
+
+    def submit(self, session_id, key, generate):
+        """Starts drafting key with generate() unless that draft already exists."""
+        if self.cache.get(key) is not None:
+            return
+        with self._lock:
+            current = self._drafts.get(session_id)
+            if current and current[0] == key:
+                return
+            if current:
+                current[1].cancel()
+            self._drafts[session_id] = (key, self._executor.submit(self._run, key, generate))
+
+    def _run(self, key, generate):
+        report = generate()
+        self.cache.put(key, report)
+        return report
+
+    def wait(self, session_id, key, timeout=DRAFT_WAIT):
+        """Returns the session's draft for key if it finishes within timeout, else None.
+
+        A draft still queued behind other sessions' drafts is cancelled rather
+        than waited for; the caller then generates the report itself.
+        """
+        with self._lock:
+            current = self._drafts.pop(session_id, None)
+        if not current or current[0] != key or current[1].cancel():
+            return None
+        try:
+            return current[1].result(timeout)
+        except Exception:
+            # A failed or cancelled draft just means generating it in the foreground
+            return None
+
+
+@st.cache_resource
+def get_drafter():
+    return DebriefDrafter(get_debrief_cache(), SPECULATIVE_WORKERS)
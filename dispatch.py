@@ -0,0 +1,186 @@
+"""Bounded, fair dispatch of model calls across all sessions.
+
+Every Gemini call takes a slot from a process-wide Dispatcher before it is
+sent. At most CHRYSALIS_LLM_CONCURRENCY calls run at once; the rest wait in
+per-user FIFO queues that are served round-robin, so one trainee hammering
+Enter cannot starve the rest of the cohort. The scheduling state lives on an
+asyncio loop in a background thread; script threads block on their slot and
+can report their queue position while they wait.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import os
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+# Model calls allowed in flight at once across the process
+LLM_CONCURRENCY = int(os.environ.get("CHRYSALIS_LLM_CONCURRENCY", "8"))
+# How often a waiting caller is told its queue position
+POSITION_POLL_SECONDS = 0.25
+
+
+class Dispatcher:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="llm-dispatch", daemon=True).start()
+        self._tickets = itertools.count()
+        # user -> deque of (ticket, future); dict order is the round-robin rotation
+        self._queues = OrderedDict()
+        self._active = 0
+        # Tickets currently holding a slot, and tickets given up before _acquire ran
+        self._held = set()
+        self._abandoned = set()
+        self._waits = deque(maxlen=2000)
+        self.dispatched = 0
+
+    # --- Scheduling state (only touched on the loop thread) ---
+
+    async def _acquire(self, user, ticket):
+        if ticket in self._abandoned:
+            # Given up before this ever ran
+            self._abandoned.discard(ticket)
+            raise asyncio.CancelledError
+        if self._active < self.concurrency and not self._queues:
+            self._active += 1
+            self._held.add(ticket)
+            return
+        granted = self._loop.create_future()
+        self._queues.setdefault(user, deque()).append((ticket, granted))
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                # Granted at the same moment the caller gave up
+                self._release(ticket)
+            else:
+                self._unqueue(user, ticket)
+            raise
+
+    def _unqueue(self, user, ticket):
+        """Removes a waiting ticket; returns its future, or None if it was no longer queued."""
+        queue = self._queues.get(user)
+        entry = next((e for e in queue if e[0] == ticket), None) if queue else None
+        if entry is None:
+            return None
+        queue.remove(entry)
+        if not queue:
+            del self._queues[user]
+        return entry[1]
+
+    def _abandon(self, user, ticket):
+        """The caller stopped waiting (or errored): free whatever the ticket holds."""
+        if ticket in self._held:
+            self._release(ticket)
+            return
+        granted = self._unqueue(user, ticket)
+        if granted is not None:
+            granted.cancel()
+        else:
+            self._abandoned.add(ticket)
+
+    def _release(self, ticket):
+        if ticket not in self._held:
+            return
+        self._held.discard(ticket)
+        self._active -= 1
+        self._grant()
+
+    def _grant(self):
+        while self._active < self.concurrency and self._queues:
+            user, queue = next(iter(self._queues.items()))
+            ticket, granted = queue.popleft()
+            # Served users go to the back of the rotation
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue
+            if granted.done():
+                # Cancelled by a caller that has not woken up to remove it yet
+                continue
+            self._active += 1
+            self._held.add(ticket)
+            granted.set_result(None)
+
+    async def _position(self, user, ticket):
+        queue = self._queues.get(user, ())
+        index = next((i for i, (t, _) in enumerate(queue) if t == ticket), None)
+        if index is None:
+            return 0
+        ahead = index
+        before = True
+        for other, other_queue in self._queues.items():
+            if other == user:
+                before = False
+                continue
+            # Round-robin serves earlier users one more time in our round
+            ahead += min(len(other_queue), index + 1 if before else index)
+        return ahead + 1
+
+    async def _stats(self):
+        return self._active, sum(len(q) for q in self._queues.values())
+
+    # --- Called from script threads ---
+
+    def position(self, user, ticket):
+        """1-based position of a waiting ticket in the serving order (0 once running)."""
+        return asyncio.run_coroutine_threadsafe(self._position(user, ticket), self._loop).result()
+
+    @contextmanager
+    def slot(self, user, on_wait=None):
+        """Blocks until this user's call may run and holds the slot for the block.
+
+        on_wait(position) is called periodically while the call is queued.
+        """
+        ticket = next(self._tickets)
+        queued_at = time.monotonic()
+        acquired = asyncio.run_coroutine_threadsafe(self._acquire(user, ticket), self._loop)
+        try:
+            while True:
+                try:
+                    acquired.result(timeout=POSITION_POLL_SECONDS)
+                    break
+                except concurrent.futures.TimeoutError:
+                    if on_wait:
+                        on_wait(self.position(user, ticket))
+        except BaseException:
+            # Script stopped (rerun, disconnect) while queued: give the place (or a slot granted meanwhile) up.
+            # Decided on the loop, which alone knows whether the ticket was granted.
+            self._loop.call_soon_threadsafe(self._abandon, user, ticket)
+            raise
+
+        self._waits.append(time.monotonic() - queued_at)
+        self.dispatched += 1
+        try:
+            yield
+        finally:
+            self._loop.call_soon_threadsafe(self._release, ticket)
+
+    def stats(self):
+        """Snapshot of load and queue wait times (seconds)."""
+        waits = sorted(self._waits)
+        active, queued = asyncio.run_coroutine_threadsafe(self._stats(), self._loop).result()
+        if len(waits) >= 2:
+            percentiles = statistics.quantiles(waits, n=100, method="inclusive")
+            p50, p99 = percentiles[49], percentiles[98]
+        else:
+            p50 = p99 = waits[0] if waits else 0.0
+        return {
+            "concurrency": self.concurrency,
+            "active": active,
+            "queued": queued,
+            "dispatched": self.dispatched,
+            "wait_p50": p50,
+            "wait_p99": p99,
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+
+@st.cache_resource
+def get_dispatcher():
+    return Dispatcher(LLM_CONCURRENCY)
@@ -0,0 +1,219 @@
+"""Deterministic local stand-in for the Gemini backend.
+
+Selected with CHRYSALIS_LLM_BACKEND=fake. It mimics the parts of the
+google.generativeai surface the app uses (GenerativeModel.generate_content,
+start_chat/send_message/rewind, streamed chunks with .text, usage_metadata),
+answers with canned persona lines, a templated Adherence Feedback report or a
+clipped running summary, and sleeps according to configurable latency
+distributions. That makes it possible to benchmark and load-test the
+Streamlit side offline without quota.
+
+Latency specs (CHRYSALIS_FAKE_TTFT for time to first chunk,
+CHRYSALIS_FAKE_CHUNK for the gap between chunks), in milliseconds:
+    fixed:300    uniform:200,800    lognormal:6.0,0.4    (mu, sigma of ln ms)
+CHRYSALIS_FAKE_PREFILL adds time per 1000 prompt tokens, so longer prompts
+answer later as they do on the real service.
+"""
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+FAKE_TTFT = os.environ.get("CHRYSALIS_FAKE_TTFT", "lognormal:6.2,0.35")
+FAKE_CHUNK = os.environ.get("CHRYSALIS_FAKE_CHUNK", "uniform:20,60")
+FAKE_PREFILL_MS = float(os.environ.get("CHRYSALIS_FAKE_PREFILL", "40"))
+FAKE_SEED = int(os.environ.get("CHRYSALIS_FAKE_SEED", "0"))
+# Words per streamed chunk
+CHUNK_WORDS = 4
+# Upper bound on the length of a fake running summary
+SUMMARY_CHARS = 800
+
+PERSONA_LINES = {
+    "David": [
+        "I don't know... it's like the walls are breathing. Can you just make it stop?",
+        "Okay. I'm trying to breathe. My chest is so tight though.",
+        "Are you sure this is normal? It feels like I'm disappearing.",
+        "Your voice helps a little. Can you stay right here with me?",
+        "It's still dark, but it's... less sharp. I think I can lie back down.",
+    ],
+    "Alex": [
+        "I guess I just didn't expect to need that. It felt so... childish.",
+        "Thank you for saying that. I keep replaying the moment in my head.",
+        "My mom wasn't really a hugger. Maybe that's part of it?",
+        "I don't know if I'd want that again. Is it okay not to know?",
+        "It's strange, talking about it makes the grief feel closer again.",
+    ],
+    "Bruce": [
+        "But the guy on the podcast said one session changed everything for him.",
+        "So you're saying it might not work? Then why am I doing this?",
+        "I've tried six different medications. I really need something to work this time.",
+        "Okay... integration. What does that actually look like week to week?",
+        "I suppose I can hold it a bit more loosely. It's just hard to let go of the hope.",
+    ],
+}
+DEFAULT_LINES = ["I'm not sure what to say to that.", "Can you tell me more?"]
+
+DEBRIEF_SECTIONS = [
+    "Attunement & Safety",
+    "Validation Without Amplification",
+    "Clinical Judgment",
+    "Therapist Metaskills",
+]
+RATINGS = ["🟢", "🟢", "🟡", "🔴"]
+
+
+def parse_latency(spec):
+    """Returns a sampler (rng -> seconds) for a latency spec like 'uniform:200,800'."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(values[0], values[1]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def _text_of(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, dict):
+        return " ".join(_text_of(part) for part in content.get("parts", []))
+    if isinstance(content, (list, tuple)):
+        return " ".join(_text_of(item) for item in content)
+    return str(content)
+
+
+def _seed(*texts):
+    return int(hashlib.sha256("\x00".join(texts).encode("utf-8")).hexdigest()[:12], 16) ^ FAKE_SEED
+
+
+class FakeResponse:
+    """Iterates over text chunks like a streamed GenerateContentResponse."""
+
+    def __init__(self, text, prompt_tokens, chunk_delay, rng, stream):
+        words = text.split(" ")
+        self._chunks = [" ".join(words[i:i + CHUNK_WORDS]) + " " for i in range(0, len(words), CHUNK_WORDS)]
+        self._chunks[-1] = self._chunks[-1].rstrip(" ")
+        self._chunk_delay = chunk_delay
+        self._rng = rng
+        self._stream = stream
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text) // 4 + 1,
+            total_token_count=prompt_tokens + len(text) // 4 + 1,
+        )
+
+    def __iter__(self):
+        for index, chunk in enumerate(self._chunks):
+            if self._stream and index:
+                time.sleep(self._chunk_delay(self._rng))
+            yield SimpleNamespace(text=chunk)
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, request_options=None, **kwargs):
+        self.history.append({"role": "user", "parts": [_text_of(content)]})
+        response = self.model.generate_content(self.history, stream=stream)
+        self.history.append({"role": "model", "parts": [response.text]})
+        return response
+
+    def rewind(self):
+        return self.history.pop(-2), self.history.pop()
+
+
+class FakeModel:
+    def __init__(self, model_name, system_instruction, ttft, chunk_delay):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+        match = re.search(r'named "(\w+)', self.system_instruction)
+        self.persona = match.group(1) if match else None
+        self.summarizer = "running summary" in self.system_instruction
+        self._ttft = ttft
+        self._chunk_delay = chunk_delay
+        self._latency_rng = random.Random(FAKE_SEED)
+        self._lock = threading.Lock()
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        prompt = _text_of(contents)
+        with self._lock:
+            latency_rng = random.Random(self._latency_rng.random())
+        if self.persona:
+            text = self._persona_reply(contents)
+        elif self.summarizer:
+            text = self._summary(prompt)
+        else:
+            text = self._report(prompt)
+        prompt_tokens = (len(self.system_instruction) + len(prompt)) // 4 + 1
+        time.sleep(self._ttft(latency_rng) + prompt_tokens / 1000 * FAKE_PREFILL_MS / 1000)
+        response = FakeResponse(text, prompt_tokens, self._chunk_delay, latency_rng, stream)
+        if not stream:
+            # A non-streamed call returns only once the whole text is "generated"
+            time.sleep(sum(self._chunk_delay(latency_rng) for _ in response._chunks[1:]))
+        return response
+
+    def _persona_reply(self, contents):
+        turns = contents if isinstance(contents, list) else [contents]
+        lines = PERSONA_LINES.get(self.persona, DEFAULT_LINES)
+        # Walk through the persona's lines from a start picked by the conversation's opening
+        user_turns = [t for t in turns if not isinstance(t, dict) or t.get("role") == "user"]
+        start = _seed(_text_of(user_turns[:2])) % len(lines)
+        return lines[(start + len(user_turns)) % len(lines)]
+
+    def _summary(self, prompt):
+        # Previous summary plus the first few words of each new line, capped like a real summary
+        previous = re.search(r"Summary so far:\n(.*?)\n\n", prompt, re.DOTALL)
+        points = [f"{speaker} said \"{' '.join(text.split()[:6])}...\""
+                  for speaker, text in re.findall(r"^(\w+): (.+)$", prompt, re.MULTILINE)]
+        summary = " ".join(([previous.group(1)] if previous and not previous.group(1).startswith("(") else []) + points)
+        return summary[-SUMMARY_CHARS:]
+
+    def _report(self, prompt):
+        rng = random.Random(_seed(prompt))
+        quotes = re.findall(r"^Therapist: (.+)$", prompt, re.MULTILINE) or ["(no therapist turns)"]
+        lines = ["### Adherence Feedback", "", "#### Performance Assessment", ""]
+        for number, section in enumerate(DEBRIEF_SECTIONS, 1):
+            lines += [
+                f"**{rng.choice(RATINGS)} {number}. {section}**",
+                f"- What was done: The therapist responded in {len(quotes)} turn(s).",
+                f'- Evidence from transcript: "{rng.choice(quotes)}"',
+                "",
+            ]
+        lines += [
+            "#### Specific Recommendations",
+            "1. Slow down and name what you notice before offering reassurance.",
+            "2. Invite the participant to stay with the sensation a little longer.",
+        ]
+        return "\n".join(lines)
+
+
+class FakeBackend:
+    name = "fake"
+
+    def __init__(self, ttft=FAKE_TTFT, chunk=FAKE_CHUNK):
+        self._ttft = parse_latency(ttft)
+        self._chunk_delay = parse_latency(chunk)
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def get_model(self, model_name, generation_config=None, system_instruction=None):
+        key = (model_name, system_instruction)
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = FakeModel(model_name, system_instruction, self._ttft, self._chunk_delay)
+            return self._models[key]
+
+    def get_prefixed_model(self, model_name, prefix):
+        return self.get_model(model_name, system_instruction=prefix)
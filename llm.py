@@ -0,0 +1,151 @@
+"""Model access shared by every browser session.
+
+The app only talks to models through get_model() and get_prefixed_model()
+(a model whose system instruction is a long static prefix, which a backend
+may cache provider-side), both answered by the configured backend
+(CHRYSALIS_LLM_BACKEND: "gemini" or "fake"). Whatever a
+backend returns must offer the slice of the google.generativeai API the app
+uses: generate_content(contents, stream=, request_options=) and
+start_chat(history=) -> send_message(content, stream=, request_options=) /
+rewind(), with responses that iterate chunks carrying .text and report
+usage_metadata. The fake backend lives in fake_llm.py.
+
+For Gemini, models are kept in a process-wide registry keyed by model name,
+generation config and system instruction, so a whole cohort logging in reuses
+the same objects. All of them send their requests over one small pool of
+long-lived gRPC channels (round-robin per call) instead of each session
+negotiating its own connection.
+"""
+import itertools
+import json
+import os
+import threading
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+import grpc
+import streamlit as st
+from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+    GenerativeServiceGrpcTransport,
+)
+
+import prompt_cache
+
+LLM_BACKEND = os.environ.get("CHRYSALIS_LLM_BACKEND", "gemini")
+
+GEMINI_HOST = "generativelanguage.googleapis.com:443"
+# Number of gRPC channels shared by all sessions in this process
+LLM_POOL_SIZE = int(os.environ.get("CHRYSALIS_LLM_POOL_SIZE", "4"))
+# Ping interval that keeps idle channels (and their TLS sessions) open
+LLM_KEEPALIVE_MS = int(os.environ.get("CHRYSALIS_LLM_KEEPALIVE_MS", "30000"))
+
+
+class _ApiKeyAuth(grpc.AuthMetadataPlugin):
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    def __call__(self, context, callback):
+        callback((("x-goog-api-key", self.api_key),), None)
+
+
+class ChannelPool:
+    """Round-robins generative service calls over several keep-alive channels."""
+
+    def __init__(self, api_key, size, keepalive_ms):
+        credentials = grpc.composite_channel_credentials(
+            grpc.ssl_channel_credentials(),
+            grpc.metadata_call_credentials(_ApiKeyAuth(api_key)),
+        )
+        options = [
+            ("grpc.keepalive_time_ms", keepalive_ms),
+            ("grpc.keepalive_timeout_ms", 10000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+            ("grpc.max_receive_message_length", -1),
+        ]
+        self._clients = [
+            glm.GenerativeServiceClient(
+                transport=GenerativeServiceGrpcTransport(
+                    channel=grpc.secure_channel(GEMINI_HOST, credentials, options=options)
+                )
+            )
+            for _ in range(size)
+        ]
+        self._turn = itertools.count()
+
+    def __getattr__(self, name):
+        client = self._clients[next(self._turn) % len(self._clients)]
+        return getattr(client, name)
+
+
+class ModelRegistry:
+    """Process-wide GenerativeModel objects, created once per configuration."""
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def get(self, model_name, generation_config=None, system_instruction=None):
+        key = (model_name, json.dumps(generation_config, sort_keys=True), system_instruction)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name,
+                    generation_config=generation_config,
+                    system_instruction=system_instruction,
+                )
+                if self.pool is not None:
+                    # GenerativeModel creates its client lazily; give it the shared pool instead
+                    model._client = self.pool
+                self._models[key] = model
+            return model
+
+
+@st.cache_resource
+def get_model_registry():
+    api_key = os.environ.get("GEMINI_API_KEY")
+    # Without a key, fall back to the library's default client (and its errors)
+    pool = ChannelPool(api_key, LLM_POOL_SIZE, LLM_KEEPALIVE_MS) if api_key and LLM_POOL_SIZE > 0 else None
+    return ModelRegistry(pool)
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.prompt_cache = prompt_cache.PromptCache(
+            registry,
+            prompt_cache.PROMPT_CACHE_TTL,
+            prompt_cache.PROMPT_CACHE_RENEW,
+            prompt_cache.PROMPT_CACHE_MIN_TOKENS,
+            prompt_cache.PROMPT_CACHE_ENABLED,
+        )
+
+    def get_model(self, model_name, generation_config=None, system_instruction=None):
+        return self.registry.get(model_name, generation_config, system_instruction)
+
+    def get_prefixed_model(self, model_name, prefix):
+        return self.prompt_cache.get_model(model_name, prefix)
+
+
+@st.cache_resource
+def get_backend():
+    if LLM_BACKEND == "fake":
+        import fake_llm
+        return fake_llm.FakeBackend()
+    if LLM_BACKEND != "gemini":
+        raise ValueError(f"Unknown CHRYSALIS_LLM_BACKEND: {LLM_BACKEND}")
+    return GeminiBackend(get_model_registry())
+
+
+def get_model(model_name, generation_config=None, system_instruction=None):
+    """Returns the shared model for this configuration from the active backend."""
+    return get_backend().get_model(model_name, generation_config, system_instruction)
+
+
+def get_prefixed_model(model_name, prefix):
+    """Returns a model whose context starts with prefix; send only the variable part."""
+    return get_backend().get_prefixed_model(model_name, prefix)
@@ -0,0 +1,424 @@
+"""Asset serving for the Chrysalis app.
+
+Streamlit re-runs the whole script on every click, so anything inlined into the
+page (e.g. base64 video) is shipped to the browser again on each rerun. Instead,
+files under assets/ are registered under a hash of their contents and the page
+only carries their URLs.
+
+By default they are published into static/ under that hash and served by
+Streamlit itself (server.enableStaticServing, see .streamlit/config.toml):
+same origin as the app, with Range and ETag support. Optionally a small HTTP
+sidecar serves them instead, with long-lived cache headers and Range requests
+answered straight from a memory-mapped copy of each file; it listens on its own
+port, so it is only used once an operator has made that port reachable and set
+CHRYSALIS_ASSET_BASE_URL to the address browsers should use for it. With
+neither available, assets are inlined as data URIs.
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import streamlit as st
+from PIL import Image, ImageOps
+
+# Sidecar configuration
+ASSET_HOST = os.environ.get("CHRYSALIS_ASSET_HOST", "0.0.0.0")
+ASSET_PORT = int(os.environ.get("CHRYSALIS_ASSET_PORT", "8599"))
+# URL trainees' browsers use to reach the sidecar, e.g. http://clinic-server:8599;
+# the sidecar only runs when this is set
+ASSET_BASE_URL = os.environ.get("CHRYSALIS_ASSET_BASE_URL", "").rstrip("/")
+ASSET_SERVER_ENABLED = bool(ASSET_BASE_URL) and os.environ.get("CHRYSALIS_ASSET_SERVER", "1") != "0"
+# Streamlit's static folder (next to app.py) and the page-relative URL it is served under
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_URL = "app/static"
+# Memory budget for encoded payloads that still have to be inlined
+ASSET_CACHE_MB = float(os.environ.get("CHRYSALIS_ASSET_CACHE_MB", "64"))
+# Written by build_assets.py
+MANIFEST_PATH = os.environ.get("CHRYSALIS_ASSET_MANIFEST", "assets/build/manifest.json")
+
+# Widths each image is displayed at, pre-rendered once per process
+IMAGE_WIDTHS = {
+    "assets/chrysalis-logo.png": (400, 250),
+    "assets/chrysalis-logo-square.jpg": (120,),
+}
+FAVICON_SOURCE = "assets/chrysalis-logo-square.jpg"
+FAVICON_SIZES = (16, 32, 64)
+
+# Which rendition each display slot should use
+SLOT_RENDITIONS = {
+    "tile": "small",    # 200px lobby tiles
+    "dojo": "small",    # 25%-width dojo video
+    "full": "medium",
+}
+
+# Content-addressed URLs never change meaning, so browsers may cache forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Bytes written per socket send when streaming a range
+SEND_CHUNK = 256 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+logger = logging.getLogger(__name__)
+
+Asset = namedtuple("Asset", ["digest", "path", "content_type", "size", "mtime_ns"])
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:20]
+
+
+class AssetRegistry:
+    """Maps asset paths to content hashes and back."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_path = {}
+        self._by_name = {}
+        self._maps = {}
+
+    def register(self, path):
+        """Registers a file (re-hashing only if it changed) and returns its Asset."""
+        stat = os.stat(path)
+        with self._lock:
+            asset = self._by_path.get(path)
+            if asset and asset.mtime_ns == stat.st_mtime_ns and asset.size == stat.st_size:
+                return asset
+
+        digest = _file_digest(path)
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        asset = Asset(digest, os.path.abspath(path), content_type, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            self._by_path[path] = asset
+            self._by_name[self.name_for(asset)] = asset
+        return asset
+
+    def lookup(self, name):
+        with self._lock:
+            return self._by_name.get(name)
+
+    def mapped(self, asset):
+        """Returns a read-only memory map of the asset, shared by all requests."""
+        with self._lock:
+            mapped = self._maps.get(asset.digest)
+            if mapped is None:
+                with open(asset.path, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[asset.digest] = mapped
+            return mapped
+
+    @staticmethod
+    def name_for(asset):
+        return asset.digest + os.path.splitext(asset.path)[1].lower()
+
+
+def parse_range(header, size):
+    """Parses a single-range "bytes=" header into (start, end) inclusive.
+
+    Returns None when the header should be ignored (absent, malformed or
+    multi-range) and raises ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class AssetRequestHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        name = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        asset = self.registry.lookup(name)
+        if asset is None or not self.path.startswith("/assets/"):
+            self.send_error(404)
+            return
+
+        etag = f'"{asset.digest}"'
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", CACHE_CONTROL)
+            self.end_headers()
+            return
+
+        try:
+            byte_range = parse_range(self.headers.get("Range"), asset.size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{asset.size}")
+            self.end_headers()
+            return
+
+        # If-Range with a stale validator means "send the whole thing"
+        if_range = self.headers.get("If-Range")
+        if byte_range and if_range and if_range != etag:
+            byte_range = None
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{asset.size}")
+        else:
+            start, end = 0, asset.size - 1
+            self.send_response(200)
+        self.send_header("Content-Type", asset.content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", CACHE_CONTROL)
+        self.end_headers()
+        if send_body and asset.size:
+            view = memoryview(self.registry.mapped(asset))
+            try:
+                for offset in range(start, end + 1, SEND_CHUNK):
+                    self.wfile.write(view[offset:min(offset + SEND_CHUNK, end + 1)])
+            except (BrokenPipeError, ConnectionResetError):
+                # Browsers routinely drop a range request once they have enough
+                pass
+            finally:
+                view.release()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource
+def get_asset_server():
+    """Starts the sidecar once per process. Returns (registry, server or None)."""
+    registry = AssetRegistry()
+    if not ASSET_SERVER_ENABLED:
+        return registry, None
+
+    handler = type("Handler", (AssetRequestHandler,), {"registry": registry})
+    try:
+        server = ThreadingHTTPServer((ASSET_HOST, ASSET_PORT), handler)
+    except OSError as e:
+        logger.warning("Asset server unavailable on port %d (%s); falling back to inline assets", ASSET_PORT, e)
+        return registry, None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="asset-server", daemon=True).start()
+    return registry, server
+
+
+class AssetCache:
+    """Process-wide LRU of encoded asset payloads, bounded by total size.
+
+    Entries are keyed by path, mtime, size and encoding, so editing a file on
+    disk invalidates it without any explicit flush.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, encoder, encoding):
+        """Returns encoder(path), computing it only on a cache miss."""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, encoding)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = encoder(path)
+        size = len(value)
+        with self._lock:
+            if key in self._entries or size > self.budget_bytes:
+                return value
+            # Older versions of the same file can never be hit again
+            for stale in [k for k in self._entries if k[0] == key[0] and k[3] == encoding]:
+                self._bytes -= len(self._entries.pop(stale))
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+@st.cache_resource
+def get_asset_cache():
+    return AssetCache(int(ASSET_CACHE_MB * 1024 * 1024))
+
+
+def encode_b64(path):
+    """Reads a file and returns its base64 encoded string."""
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def _encode_data_uri(path):
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return f"data:{content_type};base64,{encode_b64(path)}"
+
+
+def data_uri(path):
+    """Returns a file as a base64 data URI, encoded once per process."""
+    return get_asset_cache().get(path, _encode_data_uri, "data-uri")
+
+
+def static_serving():
+    """Whether Streamlit serves STATIC_DIR (server.enableStaticServing)."""
+    try:
+        return bool(st.get_option("server.enableStaticServing"))
+    except RuntimeError:
+        return False
+
+
+def publish(registry, asset):
+    """Copies an asset into STATIC_DIR under its content-hash name (once) and returns that name."""
+    name = registry.name_for(asset)
+    target = os.path.join(STATIC_DIR, name)
+    if not os.path.exists(target):
+        os.makedirs(STATIC_DIR, exist_ok=True)
+        # Copy then rename, so a concurrent request never sees a partial file
+        fd, partial = tempfile.mkstemp(dir=STATIC_DIR, prefix=".publish-")
+        with os.fdopen(fd, "wb") as out, open(asset.path, "rb") as src:
+            shutil.copyfileobj(src, out)
+        os.replace(partial, target)
+    return name
+
+
+def asset_url(path):
+    """Returns a browser-cacheable URL for an asset, or None if it doesn't exist."""
+    if not os.path.exists(path):
+        return None
+    registry, server = get_asset_server()
+    if server is not None:
+        asset = registry.register(path)
+        return f"{ASSET_BASE_URL}/assets/{registry.name_for(asset)}"
+    if static_serving():
+        return f"{STATIC_URL}/{publish(registry, registry.register(path))}"
+    return data_uri(path)
+
+
+@st.cache_resource
+def load_manifest():
+    """Reads the build manifest once per process; {} if assets were never built."""
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(MANIFEST_PATH)
+    assets = {}
+    for src, entry in manifest.get("assets", {}).items():
+        assets[src] = {
+            "renditions": {name: os.path.join(base, p) for name, p in entry.get("renditions", {}).items()},
+            "poster": os.path.join(base, entry["poster"]) if entry.get("poster") else None,
+        }
+    return assets
+
+
+def rendition(path, slot):
+    """Returns the built rendition of an asset for a display slot, or the source itself."""
+    entry = load_manifest().get(path)
+    if entry:
+        built = entry["renditions"].get(SLOT_RENDITIONS.get(slot, "medium"))
+        if built and os.path.exists(built):
+            return built
+    return path
+
+
+def poster(path):
+    """Returns the poster frame built for a video, or None."""
+    entry = load_manifest().get(path)
+    if entry and entry["poster"] and os.path.exists(entry["poster"]):
+        return entry["poster"]
+    return None
+
+
+def _encode_image(image):
+    # Same format choice st.image makes, so it passes the bytes through untouched
+    out = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(out, format="PNG", optimize=True)
+    else:
+        image.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+@st.cache_resource
+def load_images():
+    """Decodes each image once and renders every size the app shows it at."""
+    rendered = {}
+    for path, widths in IMAGE_WIDTHS.items():
+        if not os.path.exists(path):
+            continue
+        with Image.open(path) as image:
+            image.load()
+            for width in widths:
+                height = round(image.height * width / image.width)
+                resized = image.resize((width, height), Image.LANCZOS) if width < image.width else image
+                rendered[(path, width)] = _encode_image(resized)
+
+    if os.path.exists(FAVICON_SOURCE):
+        with Image.open(FAVICON_SOURCE) as image:
+            image.load()
+            for size in FAVICON_SIZES:
+                icon = ImageOps.fit(image.convert("RGBA"), (size, size), Image.LANCZOS)
+                out = io.BytesIO()
+                icon.save(out, format="PNG")
+                rendered[("favicon", size)] = out.getvalue()
+    return rendered
+
+
+def thumbnail(path, width):
+    """Returns encoded bytes of an image pre-rendered at width, or None."""
+    return load_images().get((path, width))
+
+
+def favicon(size=64):
+    """Returns the favicon as PNG bytes, or None if the logo is missing."""
+    return load_images().get(("favicon", size))
@@ -0,0 +1,143 @@
+"""Gemini context caching for long static prompt prefixes.
+
+The debrief rubrics are sent before the transcript as the model's system
+instruction. When the provider accepts it, each rubric is uploaded once as a
+CachedContent and debriefs are generated from a model bound to that cache,
+so the rubric's input tokens are billed at the cached rate. Handles are kept
+here per (model, prefix) and have their TTL extended shortly before they
+expire. Prefixes below the provider's minimum cacheable size, models that do
+not support caching and failed uploads all fall back to sending the prefix
+as a plain system instruction, which still leaves it first and identical
+across calls for any implicit prefix caching.
+"""
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+import google.generativeai as genai
+from google.generativeai import caching
+
+import ratelimit
+
+PROMPT_CACHE_ENABLED = os.environ.get("CHRYSALIS_PROMPT_CACHE", "1") == "1"
+# Lifetime of an uploaded prefix, and how long before expiry it is renewed (seconds)
+PROMPT_CACHE_TTL = int(os.environ.get("CHRYSALIS_PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE_RENEW = int(os.environ.get("CHRYSALIS_PROMPT_CACHE_RENEW", "300"))
+# Smallest prefix (estimated tokens) the provider will cache for the configured models
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("CHRYSALIS_PROMPT_CACHE_MIN_TOKENS", "32768"))
+# After a failed upload, use the plain prefix for this long before trying again
+PROMPT_CACHE_RETRY = 600
+
+
+class _Handle:
+    def __init__(self, content, expires_at):
+        self.content = content
+        self.expires_at = expires_at
+        self.model = None
+
+
+class PromptCache:
+    """Cached-content handles per (model, prefix), renewed before they lapse."""
+
+    def __init__(self, registry, ttl, renew, min_tokens, enabled=True):
+        self.registry = registry
+        self.ttl = ttl
+        self.renew = renew
+        self.min_tokens = min_tokens
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._handles = {}
+        # key -> lock held while that prefix is uploaded or renewed
+        self._key_locks = {}
+        # key -> monotonic time until which caching is not attempted
+        self._unavailable = {}
+        self.uploads = 0
+        self.renewals = 0
+        self.fallbacks = 0
+
+    def _cacheable(self, key, prefix):
+        if not self.enabled or ratelimit.estimate_tokens(prefix) < self.min_tokens:
+            return False
+        return self._unavailable.get(key, 0) <= time.monotonic()
+
+    def _fallback(self, model_name, prefix):
+        with self._lock:
+            self.fallbacks += 1
+        return self.registry.get(model_name, system_instruction=prefix)
+
+    def get_model(self, model_name, prefix):
+        """A model that answers with prefix as its (cached, if possible) context."""
+        key = (model_name, hashlib.sha256(prefix.encode("utf-8")).hexdigest())
+        with self._lock:
+            handle, cacheable = self._lookup(key, prefix)
+            # Uploads and renewals are network calls: only callers of the same prefix wait for them
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        if handle is not None:
+            return handle.model
+        if not cacheable:
+            return self._fallback(model_name, prefix)
+        with key_lock:
+            with self._lock:
+                # Another caller may have uploaded, renewed or failed while we waited
+                handle, cacheable = self._lookup(key, prefix)
+                stale = self._handles.get(key)
+            if handle is not None:
+                return handle.model
+            if not cacheable:
+                return self._fallback(model_name, prefix)
+            try:
+                handle = self._current(key, model_name, prefix, stale)
+            except Exception:
+                # Unsupported model, quota, network... the uncached prefix still works
+                with self._lock:
+                    self._unavailable[key] = time.monotonic() + PROMPT_CACHE_RETRY
+                    self._handles.pop(key, None)
+                return self._fallback(model_name, prefix)
+            with self._lock:
+                self._handles[key] = handle
+            return handle.model
+
+    def _lookup(self, key, prefix):
+        """(handle if it needs no renewal yet, whether key may be cached). Caller holds self._lock."""
+        handle = self._handles.get(key)
+        if handle is not None and handle.expires_at - time.monotonic() >= self.renew:
+            return handle, True
+        return None, self._cacheable(key, prefix)
+
+    def _current(self, key, model_name, prefix, handle):
+        """Renews handle, or uploads prefix if there is none or it is gone. Holds only key's lock."""
+        now = time.monotonic()
+        if handle is not None:
+            try:
+                handle.content.update(ttl=datetime.timedelta(seconds=self.ttl))
+                with self._lock:
+                    handle.expires_at = now + self.ttl
+                    self.renewals += 1
+                return handle
+            except Exception:
+                # Already expired or deleted on the provider side: upload again
+                pass
+        content = caching.CachedContent.create(
+            model=model_name,
+            display_name=f"chrysalis-{key[1][:16]}",
+            system_instruction=prefix,
+            ttl=datetime.timedelta(seconds=self.ttl),
+        )
+        handle = _Handle(content, now + self.ttl)
+        handle.model = genai.GenerativeModel.from_cached_content(content)
+        if self.registry.pool is not None:
+            handle.model._client = self.registry.pool
+        with self._lock:
+            self.uploads += 1
+        return handle
+
+    def stats(self):
+        with self._lock:
+            return {
+                "handles": len(self._handles),
+                "uploads": self.uploads,
+                "renewals": self.renewals,
+                "fallbacks": self.fallbacks,
+            }
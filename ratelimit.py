@@ -0,0 +1,149 @@
+"""Client-side shaping of Gemini traffic to stay inside the API quota.
+
+Each API key gets two token buckets, one for requests per minute and one for
+tokens per minute. Callers reserve capacity before sending and sleep until the
+reservation is covered, so bursts are smoothed out locally instead of coming
+back as 429s. Buckets live in memory (shared by every session in the process)
+or, with CHRYSALIS_RATE_LIMIT_DB set, in a SQLite file so several server
+processes on one host share one budget.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import streamlit as st
+
+# Set these to the quota of the project behind GEMINI_API_KEY
+LLM_RPM = float(os.environ.get("CHRYSALIS_LLM_RPM", "60"))
+LLM_TPM = float(os.environ.get("CHRYSALIS_LLM_TPM", "1000000"))
+# Optional SQLite file shared by all processes using the same key
+RATE_LIMIT_DB = os.environ.get("CHRYSALIS_RATE_LIMIT_DB", "")
+
+# Rough size of a token for estimating a prompt before it is sent
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(*texts):
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN + 1
+
+
+def _take(tokens, updated, capacity, per_second, amount, now):
+    """Refills a bucket up to now and reserves amount from it.
+
+    Returns the new (tokens, updated) state and how long the caller must wait
+    until its reservation is covered. Tokens may go negative: later callers
+    then queue behind earlier reservations.
+    """
+    tokens = min(capacity, tokens + (now - updated) * per_second)
+    tokens -= min(amount, capacity)
+    wait = -tokens / per_second if tokens < 0 else 0.0
+    return tokens, now, wait
+
+
+class _MemoryBuckets:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def reserve(self, key, capacity, per_second, amount):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._state.get(key, (capacity, now))
+            tokens, updated, wait = _take(tokens, updated, capacity, per_second, amount, now)
+            self._state[key] = (tokens, updated)
+        return wait
+
+
+class _SqliteBuckets:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def reserve(self, key, capacity, per_second, amount):
+        db = self._connect()
+        try:
+            # IMMEDIATE takes the write lock up front so processes serialize here
+            db.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens, updated, wait = _take(tokens, updated, capacity, per_second, amount, now)
+            db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, updated))
+            db.execute("COMMIT")
+            return wait
+        finally:
+            db.close()
+
+
+class RateLimiter:
+    """Requests/minute and tokens/minute buckets per API key."""
+
+    def __init__(self, rpm, tpm, buckets):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+
+    @staticmethod
+    def _key(api_key):
+        return hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+
+    def reserve(self, api_key, tokens):
+        """Reserves one request and tokens; returns seconds to wait before sending."""
+        key = self._key(api_key)
+        wait = max(
+            self.buckets.reserve(key + ":rpm", self.rpm, self.rpm / 60, 1),
+            self.buckets.reserve(key + ":tpm", self.tpm, self.tpm / 60, tokens),
+        )
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+            if wait > 0:
+                self.throttled_requests += 1
+                self.throttled_seconds += wait
+        return wait
+
+    def acquire(self, api_key, tokens):
+        """Blocks until the request fits the quota. Returns the time spent waiting."""
+        wait = self.reserve(api_key, tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def settle(self, api_key, estimated, actual):
+        """Corrects a reservation once the real token count is known."""
+        if actual is None or actual == estimated:
+            return
+        # A negative amount refunds tokens that were over-estimated
+        self.buckets.reserve(self._key(api_key) + ":tpm", self.tpm, self.tpm / 60, actual - estimated)
+        with self._lock:
+            self.tokens += actual - estimated
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rpm_limit": self.rpm,
+                "tpm_limit": self.tpm,
+                "requests": self.requests,
+                "tokens": self.tokens,
+                "throttled_requests": self.throttled_requests,
+                "throttled_seconds": self.throttled_seconds,
+            }
+
+
+@st.cache_resource
+def get_rate_limiter():
+    buckets = _SqliteBuckets(RATE_LIMIT_DB) if RATE_LIMIT_DB else _MemoryBuckets()
+    return RateLimiter(LLM_RPM, LLM_TPM, buckets)
@@ -0,0 +1,147 @@
+"""Retries and circuit breaking around model calls.
+
+Transient backend errors (429/500/503/504) are retried a bounded number of
+times with full-jitter exponential backoff, each attempt under its own
+timeout and all of them within an overall deadline. A circuit breaker per
+model stops sending anything for a cooldown after repeated failures, so a
+provider incident turns into a quick "degraded mode" message rather than
+every session piling retries onto it.
+"""
+import os
+import random
+import threading
+import time
+
+import streamlit as st
+from google.api_core import exceptions as api_exceptions
+
+LLM_MAX_ATTEMPTS = int(os.environ.get("CHRYSALIS_LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE = float(os.environ.get("CHRYSALIS_LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.environ.get("CHRYSALIS_LLM_BACKOFF_MAX", "8"))
+# Per-attempt timeout and overall deadline for one logical call, in seconds
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get("CHRYSALIS_LLM_ATTEMPT_TIMEOUT", "45"))
+LLM_DEADLINE = float(os.environ.get("CHRYSALIS_LLM_DEADLINE", "90"))
+# Consecutive failures that open the breaker, and how long it stays open
+BREAKER_THRESHOLD = int(os.environ.get("CHRYSALIS_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.environ.get("CHRYSALIS_BREAKER_COOLDOWN", "30"))
+
+TRANSIENT_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend that is currently failing."""
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open probe after a cooldown."""
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+
+    def before_call(self):
+        """Raises CircuitOpenError, or returns True if this call is the half-open probe."""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                # Let exactly one probe through
+                self.state = "half-open"
+                return True
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.name} is unavailable; retry in a little while")
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_abandoned(self):
+        """The probe never finished (e.g. the script was stopped): open again for another cooldown."""
+        with self._lock:
+            if self.state == "half-open":
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+@st.cache_resource
+def _breakers():
+    return {}, threading.Lock()
+
+
+def get_breaker(name):
+    """The process-wide breaker for one model."""
+    breakers, lock = _breakers()
+    with lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name, BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+        return breakers[name]
+
+
+def breaker_stats():
+    breakers, lock = _breakers()
+    with lock:
+        return {
+            name: {"state": b.state, "failures": b.failures, "rejected": b.rejected}
+            for name, b in breakers.items()
+        }
+
+
+def request_options(timeout):
+    # Retries are ours; the client library's own retry would multiply them
+    return {"timeout": timeout, "retry": None}
+
+
+def call(attempt, breaker, on_retry=None, deadline=LLM_DEADLINE, max_attempts=LLM_MAX_ATTEMPTS):
+    """Runs attempt(timeout) until it succeeds, retrying transient errors.
+
+    Raises CircuitOpenError without calling when the breaker is open, and the
+    last error once attempts or the deadline run out. on_retry() runs before
+    each retry (e.g. to re-reserve rate-limit quota).
+    """
+    started = time.monotonic()
+    for number in range(max_attempts):
+        probe = breaker.before_call()
+        remaining = deadline - (time.monotonic() - started)
+        try:
+            result = attempt(max(1.0, min(LLM_ATTEMPT_TIMEOUT, remaining)))
+        except TRANSIENT_ERRORS:
+            breaker.record_failure()
+            delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** number))
+            if number == max_attempts - 1 or time.monotonic() - started + delay >= deadline:
+                raise
+            time.sleep(delay)
+            if on_retry:
+                on_retry()
+            continue
+        except Exception:
+            # The backend answered (e.g. invalid request); that says nothing bad about its health
+            breaker.record_success()
+            raise
+        except BaseException:
+            # Rerun/stop exceptions: an unresolved probe would leave the breaker half-open for good
+            if probe:
+                breaker.record_abandoned()
+            raise
+        breaker.record_success()
+        return result
@@ -0,0 +1,124 @@
+"""Which model serves which call.
+
+Every call type (persona turn, debrief, transcript summary) has a route: a
+primary model, an optional faster fallback and a latency SLO in seconds
+until the response starts (first chunk for streamed calls). Routes can be
+overridden per call type or per scenario and call type with
+CHRYSALIS_MODEL_ROUTES, e.g.
+
+    {"debrief": ["gemini-1.5-pro", "gemini-1.5-flash", 15],
+     "2:persona": ["gemini-1.5-pro", "gemini-1.5-flash", 5]}
+
+A call that fails on its primary (transient error or open breaker) is sent
+to the fallback straight away. A primary whose recent responses are slower
+than the SLO is skipped for a cooldown, after which it gets traffic again.
+"""
+import json
+import os
+import statistics
+import threading
+import time
+from collections import deque, namedtuple
+
+import streamlit as st
+
+import resilience
+
+Route = namedtuple("Route", "primary fallback slo")
+
+ROUTES = {
+    "persona": Route("gemini-1.5-flash", "gemini-1.5-flash-8b", 3.0),
+    "debrief": Route("gemini-1.5-pro", "gemini-1.5-flash", 15.0),
+    "summary": Route("gemini-1.5-flash-8b", "gemini-1.5-flash", 10.0),
+}
+# Responses per model looked at when checking the SLO
+ROUTE_WINDOW = int(os.environ.get("CHRYSALIS_ROUTE_WINDOW", "5"))
+# How long a primary that missed its SLO is bypassed (seconds)
+ROUTE_COOLDOWN = float(os.environ.get("CHRYSALIS_ROUTE_COOLDOWN", "60"))
+
+
+def load_routes(overrides=None):
+    """ROUTES plus overrides keyed by "kind" or "scenario:kind"."""
+    routes = {kind: route for kind, route in ROUTES.items()}
+    if overrides is None:
+        overrides = json.loads(os.environ.get("CHRYSALIS_MODEL_ROUTES", "") or "{}")
+    for key, (primary, fallback, slo) in overrides.items():
+        scenario, _, kind = key.rpartition(":")
+        routes[(int(scenario), kind) if scenario else kind] = Route(primary, fallback, float(slo))
+    return routes
+
+
+class Router:
+    def __init__(self, routes, window, cooldown):
+        self.routes = routes
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._window = window
+        # model -> recent seconds-to-first-response
+        self._samples = {}
+        # model -> monotonic time until which it is bypassed
+        self._degraded = {}
+        self.fallbacks = 0
+
+    def route(self, scenario, kind):
+        return self.routes.get((scenario, kind)) or self.routes[kind]
+
+    def choose(self, scenario, kind):
+        """The model the next call of this kind should go to."""
+        route = self.route(scenario, kind)
+        with self._lock:
+            if route.fallback and self._degraded.get(route.primary, 0) > time.monotonic():
+                return route.fallback
+        return route.primary
+
+    def observe(self, model, route, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=self._window))
+            samples.append(seconds)
+            if model == route.primary and len(samples) == samples.maxlen and statistics.median(samples) > route.slo:
+                self._degraded[model] = time.monotonic() + self.cooldown
+                samples.clear()
+
+    def call(self, scenario, kind, attempt, on_retry=None):
+        """Runs attempt(model_name, timeout) on the routed model via resilience.call.
+
+        Falls back to the route's fallback model if the primary fails with a
+        transient error or its breaker is open. Returns (model_name, response).
+        """
+        route = self.route(scenario, kind)
+        model = self.choose(scenario, kind)
+        if model == route.primary and route.fallback:
+            try:
+                return model, self._timed(route, model, attempt, on_retry, max_attempts=1)
+            except (resilience.CircuitOpenError, *resilience.TRANSIENT_ERRORS):
+                with self._lock:
+                    self.fallbacks += 1
+                if on_retry:
+                    on_retry()
+                model = route.fallback
+        return model, self._timed(route, model, attempt, on_retry)
+
+    def _timed(self, route, model, attempt, on_retry, **kwargs):
+        started = time.monotonic()
+        response = resilience.call(
+            lambda timeout: attempt(model, timeout),
+            resilience.get_breaker(model),
+            on_retry=on_retry,
+            **kwargs
+        )
+        self.observe(model, route, time.monotonic() - started)
+        return response
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "fallbacks": self.fallbacks,
+                "degraded": {model: round(until - now, 1) for model, until in self._degraded.items() if until > now},
+                "median_seconds": {model: statistics.median(s) for model, s in self._samples.items() if s},
+            }
+
+
+@st.cache_resource
+def get_router():
+    return Router(load_routes(), ROUTE_WINDOW, ROUTE_COOLDOWN)
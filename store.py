@@ -0,0 +1,529 @@
+"""Persistent store of dojo sessions, their turns and debriefs.
+
+A local SQLite file in WAL mode. Writes go through a single background
+writer that commits them in small batches (synchronous=NORMAL), so the chat
+path only enqueues and never waits for the disk; reads use per-thread
+connections and first wait for writes queued before them. A session's id
+is kept in the page URL (?sid=...), so a browser refresh or a server
+restart can pick the session up where it left off.
+
+Finished sessions are also indexed for full-text search (SQLite FTS5): their
+turns when the session ends and their debrief whenever it is saved.
+"""
+import hashlib
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import streamlit as st
+
+STORE_DB = os.environ.get("CHRYSALIS_STORE_DB", "chrysalis.db")
+# Longest a queued write waits for others to share its transaction (seconds)
+STORE_FLUSH_INTERVAL = float(os.environ.get("CHRYSALIS_STORE_FLUSH_MS", "200")) / 1000
+STORE_BATCH_SIZE = 200
+# Backoff between attempts at a batch while another process holds the database (seconds)
+STORE_RETRY_DELAY = 0.1
+STORE_RETRY_MAX_DELAY = 5.0
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    scenario INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'active',
+    started_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    ended_at REAL,
+    turn_count INTEGER NOT NULL DEFAULT 0,
+    summary TEXT NOT NULL DEFAULT '',
+    folded INTEGER NOT NULL DEFAULT 0,
+    rating TEXT,
+    headline TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS sessions_active ON sessions (user, status, updated_at);
+-- Learning History pages: (user, date) and (user, scenario, date), finished sessions only
+CREATE INDEX IF NOT EXISTS sessions_user_date ON sessions (user, started_at, id) WHERE status = 'completed';
+CREATE INDEX IF NOT EXISTS sessions_user_scenario ON sessions (user, scenario, started_at, id) WHERE status = 'completed';
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL REFERENCES sessions (id),
+    seq INTEGER NOT NULL,
+    speaker TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    UNIQUE (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS debriefs (
+    session_id TEXT PRIMARY KEY REFERENCES sessions (id),
+    model TEXT,
+    prompt_version INTEGER,
+    report TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+-- Progress aggregates, updated in the same transaction as the session they count.
+-- user '*' is everyone (cohort view); scope is 'all' (key ''), 'scenario' (key =
+-- scenario number) or 'day' (key = UTC date of the session's end).
+CREATE TABLE IF NOT EXISTS totals (
+    user TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    green INTEGER NOT NULL DEFAULT 0,
+    yellow INTEGER NOT NULL DEFAULT 0,
+    red INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, scope, key)
+) WITHOUT ROWID;
+-- One row per model call (telemetry.CallRecord); session_id is the dojo session,
+-- or the browser session for calls made outside one
+CREATE TABLE IF NOT EXISTS calls (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    scenario INTEGER,
+    kind TEXT NOT NULL,
+    model TEXT,
+    started_at REAL NOT NULL,
+    queued REAL,
+    latency REAL,
+    ttft REAL,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER,
+    cached_tokens INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS calls_session ON calls (session_id);
+CREATE INDEX IF NOT EXISTS calls_scenario ON calls (scenario, id);
+"""
+CALL_COLUMNS = ("session_id", "scenario", "kind", "model", "started_at", "queued", "latency", "ttft",
+                "prompt_tokens", "output_tokens", "cached_tokens", "error")
+
+# Full-text index of finished sessions. Turns use their turns.id as rowid and a
+# debrief uses minus its session's rowid, so either can be replaced in place.
+# user holds search_key(username), which always tokenizes to exactly one term, so a
+# trainee's search only visits their own rows whatever characters their name has.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5 (
+    text,
+    user,
+    session_id UNINDEXED,
+    scenario UNINDEXED,
+    seq UNINDEXED,
+    speaker UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+"""
+DEBRIEF_SPEAKER = "Adherence Feedback"
+MARKUP = re.compile(r"[*_#`>\[\]]")
+
+# Sessions per Learning History page
+HISTORY_PAGE_SIZE = 15
+SEARCH_LIMIT = 20
+# Turns per page of a session replay
+REPLAY_PAGE_SIZE = 30
+
+COHORT = "*"
+RATING_COLUMNS = {"🟢": "green", "🟡": "yellow", "🔴": "red"}
+EMPTY_TOTALS = {"sessions": 0, "seconds": 0.0, "green": 0, "yellow": 0, "red": 0}
+
+
+class SessionStore:
+    def __init__(self, path, flush_interval=STORE_FLUSH_INTERVAL, batch_size=STORE_BATCH_SIZE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        db = self._connect()
+        db.executescript(SCHEMA)
+        self.searchable = self._create_search(db)
+        db.close()
+        self.batches = 0
+        self.writes = 0
+        threading.Thread(target=self._writer, name="store-writer", daemon=True).start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: commits are atomic and survive a crash of the app, fsync happens at checkpoints
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA foreign_keys=ON")
+        return db
+
+    @staticmethod
+    def _create_search(db):
+        """Creates the search index. False if SQLite lacks FTS5."""
+        try:
+            db.executescript(SEARCH_SCHEMA)
+        except sqlite3.OperationalError:
+            logger.warning("SQLite was built without FTS5; session search is disabled")
+            return False
+        return True
+
+    # --- Write-behind ---
+
+    def _writer(self):
+        db = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                # An Event ends the batch: someone is waiting for everything up to it
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(db, batch)
+
+    def _commit(self, db, batch):
+        writes = [op for op in batch if not isinstance(op, threading.Event)]
+        delay = STORE_RETRY_DELAY
+        while writes:
+            try:
+                self._transaction(db, writes)
+                break
+            except Exception as e:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                if not (isinstance(e, sqlite3.OperationalError) and _busy(e)):
+                    logger.exception("Dropping a batch of %d session store writes", len(writes))
+                    break
+                # Another process holds the write lock past the busy timeout: keep the batch and retry
+                logger.warning("Session store busy (%s); retrying %d writes in %.1fs", e, len(writes), delay)
+                time.sleep(delay)
+                delay = min(delay * 2, STORE_RETRY_MAX_DELAY)
+        for op in batch:
+            if isinstance(op, threading.Event):
+                op.set()
+
+    def _transaction(self, db, writes):
+        """Runs writes in one transaction, each under its own savepoint so a failing op is dropped alone."""
+        db.execute("BEGIN IMMEDIATE")
+        applied = 0
+        for op in writes:
+            db.execute("SAVEPOINT op")
+            try:
+                op(db)
+            except Exception as e:
+                if isinstance(e, sqlite3.OperationalError) and _busy(e):
+                    raise
+                db.execute("ROLLBACK TO op")
+                logger.exception("Dropping a session store write")
+            else:
+                applied += 1
+            db.execute("RELEASE op")
+        db.execute("COMMIT")
+        self.batches += 1
+        self.writes += applied
+
+    def submit(self, op):
+        """Queues op(db) to run inside the next write transaction."""
+        self._queue.put(op)
+
+    def flush(self, timeout=5):
+        """Waits until every write queued so far is committed."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    # --- Reads ---
+
+    def _reader(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def query(self, sql, params=()):
+        self.flush()
+        return [dict(row) for row in self._reader().execute(sql, params)]
+
+    # --- Sessions ---
+
+    def start_session(self, session_id, user, scenario, opening_speaker, opening_line):
+        now = time.time()
+
+        def op(db):
+            db.execute(
+                "INSERT INTO sessions (id, user, scenario, started_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (session_id, user, scenario, now, now),
+            )
+            _insert_turn(db, session_id, 0, opening_speaker, opening_line, now)
+        self.submit(op)
+
+    def add_turns(self, session_id, first_seq, turns):
+        """Appends (speaker, text) turns numbered from first_seq."""
+        now = time.time()
+
+        def op(db):
+            for offset, (speaker, text) in enumerate(turns):
+                _insert_turn(db, session_id, first_seq + offset, speaker, text, now)
+        self.submit(op)
+
+    def save_context(self, session_id, summary, folded):
+        self.submit(lambda db: db.execute(
+            "UPDATE sessions SET summary = ?, folded = ? WHERE id = ?", (summary, folded, session_id)
+        ))
+
+    def end_session(self, session_id, status="completed"):
+        now = time.time()
+
+        def op(db):
+            ended = db.execute(
+                "UPDATE sessions SET status = ?, ended_at = ?, updated_at = ? WHERE id = ? AND status = 'active'",
+                (status, now, now, session_id),
+            ).rowcount
+            if ended and status == "completed":
+                session = db.execute("SELECT rowid, * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                _add_totals(db, session, sessions=1, seconds=session["ended_at"] - session["started_at"],
+                            ratings=((session["rating"], 1),))
+                if self.searchable:
+                    _index_session(db, session)
+        self.submit(op)
+
+    def save_debrief(self, session_id, model, prompt_version, report, rating=None, headline=""):
+        now = time.time()
+
+        def op(db):
+            db.execute(
+                "INSERT OR REPLACE INTO debriefs (session_id, model, prompt_version, report, created_at) VALUES (?, ?, ?, ?, ?)",
+                (session_id, model, prompt_version, report, now),
+            )
+            session = db.execute("SELECT rowid, * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            db.execute("UPDATE sessions SET rating = ?, headline = ? WHERE id = ?", (rating, headline, session_id))
+            if session is None or session["status"] != "completed":
+                return
+            if self.searchable:
+                _index_debrief(db, session, report)
+            if session["rating"] == rating:
+                return
+            # Move the session to its new bucket of the rating histograms
+            _add_totals(db, session, ratings=((session["rating"], -1), (rating, 1)))
+        self.submit(op)
+
+    def get_session(self, session_id):
+        rows = self.query("SELECT * FROM sessions WHERE id = ?", (session_id,))
+        return rows[0] if rows else None
+
+    def active_session(self, user):
+        """The user's most recently touched unfinished session, if any."""
+        rows = self.query(
+            "SELECT * FROM sessions WHERE user = ? AND status = 'active' ORDER BY updated_at DESC LIMIT 1", (user,)
+        )
+        return rows[0] if rows else None
+
+    def turns(self, session_id):
+        return self.query("SELECT seq, speaker, text FROM turns WHERE session_id = ? ORDER BY seq", (session_id,))
+
+    def turns_page(self, session_id, after=-1, limit=REPLAY_PAGE_SIZE):
+        """Up to limit turns of one session following seq `after`, read off its (session_id, seq) index."""
+        return self.query(
+            "SELECT seq, speaker, text FROM turns WHERE session_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (session_id, after, limit),
+        )
+
+    def history(self, user, scenario=None, before=None, limit=HISTORY_PAGE_SIZE):
+        """One page of a user's finished sessions, newest first.
+
+        before is the (started_at, id) of the last session on the previous
+        page; pages are read straight off an index however long the history.
+        """
+        where, params = ["user = ?", "status = 'completed'"], [user]
+        if scenario is not None:
+            where.append("scenario = ?")
+            params.append(scenario)
+        if before is not None:
+            where.append("(started_at, id) < (?, ?)")
+            params.extend(before)
+        return self.query(
+            "SELECT id, scenario, started_at, ended_at, turn_count, rating, headline FROM sessions "
+            f"WHERE {' AND '.join(where)} ORDER BY started_at DESC, id DESC LIMIT ?",
+            (*params, limit),
+        )
+
+    def totals(self, user=COHORT):
+        """All-time aggregates for a user (or the whole cohort): a single row read."""
+        rows = self.query(
+            "SELECT sessions, seconds, green, yellow, red FROM totals WHERE user = ? AND scope = 'all' AND key = ''",
+            (user,),
+        )
+        return rows[0] if rows else dict(EMPTY_TOTALS)
+
+    def scenario_totals(self, user=COHORT):
+        """Aggregates per scenario, keyed by scenario number."""
+        rows = self.query(
+            "SELECT key, sessions, seconds, green, yellow, red FROM totals WHERE user = ? AND scope = 'scenario'",
+            (user,),
+        )
+        return {int(row.pop("key")): row for row in rows}
+
+    def recent_totals(self, user=COHORT, days=30):
+        """Aggregates over the last `days` days, summed from at most that many daily rows."""
+        since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+        rows = self.query(
+            "SELECT COALESCE(SUM(sessions), 0) AS sessions, COALESCE(SUM(seconds), 0.0) AS seconds, "
+            "COALESCE(SUM(green), 0) AS green, COALESCE(SUM(yellow), 0) AS yellow, COALESCE(SUM(red), 0) AS red "
+            "FROM totals WHERE user = ? AND scope = 'day' AND key >= ?",
+            (user, since),
+        )
+        return rows[0]
+
+    def search(self, user, text, scenario=None, limit=SEARCH_LIMIT):
+        """Best matches for text in finished sessions' turns and debriefs.
+
+        Every word must occur (stemmed, so "grounding" also finds "grounded").
+        user=COHORT searches everyone's sessions. Returns ranked rows with a
+        snippet whose matches are wrapped in ** for markdown.
+        """
+        words = re.findall(r"\w+", text)
+        if not self.searchable or not words:
+            return []
+        match = "text : (" + " ".join(f'"{word}"' for word in words) + ")"
+        where, params = ["search MATCH ?"], []
+        if user != COHORT:
+            match = f'user : {search_key(user)} AND {match}'
+        if scenario is not None:
+            where.append("search.scenario = ?")
+            params.append(scenario)
+        rows = self.query(
+            "SELECT search.session_id, search.scenario, search.seq, search.speaker, sessions.started_at, "
+            "snippet(search, 0, char(2), char(3), '…', 16) AS snippet FROM search "
+            "JOIN sessions ON sessions.id = search.session_id "
+            f"WHERE {' AND '.join(where)} ORDER BY search.rank LIMIT ?",
+            (match, *params, limit),
+        )
+        for row in rows:
+            # Drop the debrief's own markdown so only the matches end up bold
+            row["snippet"] = MARKUP.sub("", row["snippet"]).replace("\x02", "**").replace("\x03", "**")
+        return rows
+
+    # --- Model calls ---
+
+    def add_call(self, call):
+        """Queues one call record (a dict with CALL_COLUMNS)."""
+        values = tuple(call[column] for column in CALL_COLUMNS)
+        self.submit(lambda db: db.execute(
+            f"INSERT INTO calls ({', '.join(CALL_COLUMNS)}) VALUES ({', '.join('?' * len(CALL_COLUMNS))})", values
+        ))
+
+    def calls(self, session_id=None):
+        """Call records of one session, or of every session, oldest first."""
+        where, params = ("WHERE session_id = ?", (session_id,)) if session_id is not None else ("", ())
+        return self.query(f"SELECT {', '.join(CALL_COLUMNS)} FROM calls {where} ORDER BY id", params)
+
+    def call_totals(self):
+        """Call counts and token sums per scenario, with calls per kind."""
+        totals = {
+            row.pop("scenario"): dict(row, by_kind={})
+            for row in self.query(
+                "SELECT scenario, COUNT(DISTINCT session_id) AS sessions, COUNT(*) AS calls, "
+                "SUM(error IS NOT NULL) AS errors, COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, "
+                "COALESCE(SUM(output_tokens), 0) AS output_tokens, COALESCE(SUM(cached_tokens), 0) AS cached_tokens "
+                "FROM calls GROUP BY scenario"
+            )
+        }
+        for row in self.query("SELECT scenario, kind, COUNT(*) AS calls FROM calls GROUP BY scenario, kind"):
+            totals[row["scenario"]]["by_kind"][row["kind"]] = row["calls"]
+        return totals
+
+    def call_timings(self, scenario, limit):
+        """(latency, ttft) of a scenario's most recent successful calls."""
+        return self.query(
+            "SELECT latency, ttft FROM calls WHERE scenario IS ? AND error IS NULL ORDER BY id DESC LIMIT ?",
+            (scenario, limit),
+        )
+
+    def session_call_totals(self, limit=None):
+        """Per-session call and token totals, biggest first."""
+        return self.query(
+            "SELECT session_id, MIN(scenario) AS scenario, COUNT(*) AS calls, "
+            "COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, COALESCE(SUM(output_tokens), 0) AS output_tokens, "
+            "COALESCE(MAX(prompt_tokens), 0) AS max_prompt_tokens FROM calls GROUP BY session_id "
+            "ORDER BY prompt_tokens + output_tokens DESC LIMIT ?",
+            (limit if limit else -1,),
+        )
+
+    def debrief(self, session_id):
+        rows = self.query("SELECT * FROM debriefs WHERE session_id = ?", (session_id,))
+        return rows[0] if rows else None
+
+    def stats(self):
+        return {"path": self.path, "queued": self._queue.qsize(), "batches": self.batches, "writes": self.writes}
+
+
+def _busy(error):
+    """Whether an OperationalError means the database was locked by someone else."""
+    return getattr(error, "sqlite_errorcode", None) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) \
+        or "locked" in str(error) or "busy" in str(error)
+
+
+def _add_totals(db, session, sessions=0, seconds=0.0, ratings=()):
+    """Adds one session's deltas to its user's and the cohort's aggregates.
+
+    ratings is a sequence of (rating, +1/-1) moving it within the histograms.
+    """
+    counts = dict.fromkeys(RATING_COLUMNS.values(), 0)
+    for rating, delta in ratings:
+        if rating in RATING_COLUMNS:
+            counts[RATING_COLUMNS[rating]] += delta
+    day = time.strftime("%Y-%m-%d", time.gmtime(session["ended_at"]))
+    for user in (session["user"], COHORT):
+        for scope, key in (("all", ""), ("scenario", str(session["scenario"])), ("day", day)):
+            db.execute(
+                """INSERT INTO totals (user, scope, key, sessions, seconds, green, yellow, red)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user, scope, key) DO UPDATE SET
+                    sessions = sessions + excluded.sessions,
+                    seconds = seconds + excluded.seconds,
+                    green = green + excluded.green,
+                    yellow = yellow + excluded.yellow,
+                    red = red + excluded.red""",
+                (user, scope, key, sessions, seconds, counts["green"], counts["yellow"], counts["red"]),
+            )
+
+
+def search_key(user):
+    """The search index's token for a username."""
+    return "u" + hashlib.sha256(user.encode("utf-8")).hexdigest()[:32]
+
+
+def _index_session(db, session):
+    """Adds a finished session's turns and debrief (if any) to the search index."""
+    db.execute(
+        """INSERT OR REPLACE INTO search (rowid, text, user, session_id, scenario, seq, speaker)
+        SELECT id, text, ?, session_id, ?, seq, speaker FROM turns WHERE session_id = ?""",
+        (search_key(session["user"]), session["scenario"], session["id"]),
+    )
+    report = db.execute("SELECT report FROM debriefs WHERE session_id = ?", (session["id"],)).fetchone()
+    if report is not None:
+        _index_debrief(db, session, report["report"])
+
+
+def _index_debrief(db, session, report):
+    db.execute(
+        "INSERT OR REPLACE INTO search (rowid, text, user, session_id, scenario, seq, speaker) VALUES (?, ?, ?, ?, ?, NULL, ?)",
+        (-session["rowid"], report, search_key(session["user"]), session["id"], session["scenario"], DEBRIEF_SPEAKER),
+    )
+
+
+def _insert_turn(db, session_id, seq, speaker, text, now):
+    db.execute(
+        "INSERT OR REPLACE INTO turns (session_id, seq, speaker, text, created_at) VALUES (?, ?, ?, ?, ?)",
+        (session_id, seq, speaker, text, now),
+    )
+    db.execute(
+        "UPDATE sessions SET turn_count = MAX(turn_count, ?), updated_at = ? WHERE id = ?",
+        (seq + 1, now, session_id),
+    )
+
+
+@st.cache_resource
+def get_store():
+    return SessionStore(STORE_DB)
@@ -0,0 +1,155 @@
+"""Token and latency accounting for every model call.
+
+Each call (persona turn, debrief, background debrief draft, transcript
+summary) produces one record: prompt, cached and output tokens as billed,
+queue wait, latency, time to first token and model name. Records are stored
+alongside the session in the session store (so they survive restarts and are
+shared by every server process), aggregated per scenario from there, and
+optionally appended as JSON lines to CHRYSALIS_TELEMETRY_LOG for offline
+capacity planning.
+"""
+import json
+import os
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+import streamlit as st
+
+import store
+
+# Optional JSON-lines file receiving every call record
+TELEMETRY_LOG = os.environ.get("CHRYSALIS_TELEMETRY_LOG", "")
+# Recent successful calls per scenario used for latency percentiles
+LATENCY_SAMPLES = 2000
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+class CallRecord:
+    """One model call; filled in while the call runs."""
+
+    def __init__(self, session_id, scenario, kind, model, queued=0.0):
+        self.session_id = session_id
+        self.scenario = scenario
+        self.kind = kind
+        self.model = model
+        self.queued = queued
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.response = None
+        self.ttft = None
+        self.latency = None
+        self.prompt_tokens = None
+        self.output_tokens = None
+        self.cached_tokens = None
+        self.error = None
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self._started
+
+    def finish(self, error=None):
+        self.latency = time.monotonic() - self._started
+        self.error = error
+        usage = getattr(self.response, "usage_metadata", None)
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_token_count
+            self.output_tokens = usage.candidates_token_count
+            # Part of prompt_tokens served from a cached context (billed at a lower rate)
+            self.cached_tokens = getattr(usage, "cached_content_token_count", None)
+        if self.ttft is None and error is None:
+            # Not streamed: the first token arrives with the rest
+            self.ttft = self.latency
+
+    def as_dict(self):
+        return {
+            "session_id": self.session_id,
+            "scenario": self.scenario,
+            "kind": self.kind,
+            "model": self.model,
+            "started_at": self.started_at,
+            "queued": self.queued,
+            "latency": self.latency,
+            "ttft": self.ttft,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_tokens": self.cached_tokens,
+            "error": self.error,
+        }
+
+
+class Telemetry:
+    def __init__(self, sessions, log_path=""):
+        self.sessions = sessions
+        self.log_path = log_path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, session_id, scenario, kind, model, queued=0.0):
+        """Times the block as one call; set record.response before leaving it."""
+        record = CallRecord(session_id, scenario, kind, model, queued)
+        try:
+            yield record
+        except BaseException as exc:
+            record.finish(error=type(exc).__name__)
+            self.add(record)
+            raise
+        record.finish()
+        self.add(record)
+
+    def add(self, record):
+        row = record.as_dict()
+        # Queued for the store's background writer, like the session's turns
+        self.sessions.add_call(row)
+        if self.log_path:
+            with self._lock, open(self.log_path, "a", encoding="utf-8") as log:
+                log.write(json.dumps(row) + "\n")
+
+    def session(self, session_id):
+        return self.sessions.calls(session_id)
+
+    def session_totals(self, limit=None):
+        """Per-session token totals, biggest first (to spot runaway transcripts)."""
+        return self.sessions.session_call_totals(limit)
+
+    def scenarios(self):
+        """Aggregates per scenario, with latency/TTFT percentiles in seconds."""
+        result = {}
+        for scenario, totals in sorted(self.sessions.call_totals().items(), key=lambda item: str(item[0])):
+            timings = self.sessions.call_timings(scenario, LATENCY_SAMPLES)
+            latencies = sorted(t["latency"] for t in timings if t["latency"] is not None)
+            ttfts = sorted(t["ttft"] for t in timings if t["ttft"] is not None)
+            sessions = totals["sessions"] or 1
+            result[scenario] = dict(
+                totals,
+                tokens_per_session=(totals["prompt_tokens"] + totals["output_tokens"]) / sessions,
+                latency_p50=_percentile(latencies, 50),
+                latency_p95=_percentile(latencies, 95),
+                ttft_p50=_percentile(ttfts, 50),
+                ttft_p95=_percentile(ttfts, 95),
+            )
+        return result
+
+    def export(self):
+        """Everything above as one JSON-serializable document."""
+        sessions = {}
+        for call in self.sessions.calls():
+            sessions.setdefault(call["session_id"], []).append(call)
+        return {
+            "generated_at": time.time(),
+            "scenarios": self.scenarios(),
+            "sessions": sessions,
+        }
+
+
+@st.cache_resource
+def get_telemetry():
+    return Telemetry(store.get_store(), TELEMETRY_LOG)
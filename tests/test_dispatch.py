@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from dispatch import Dispatcher
+
+
+def on_loop(dispatcher, coro):
+    return asyncio.run_coroutine_threadsafe(coro, dispatcher._loop).result(timeout=5)
+
+
+def active(dispatcher):
+    return dispatcher.stats()["active"]
+
+
+def test_cancel_while_queued_does_not_leak_a_slot():
+    dispatcher = Dispatcher(2)
+
+    async def cycle():
+        await dispatcher._acquire("a", "held-1")
+        await dispatcher._acquire("b", "held-2")
+        waiter = asyncio.ensure_future(dispatcher._acquire("c", "waiter"))
+        await asyncio.sleep(0)
+        # The waiter gives up and a slot is released before it wakes up
+        waiter.cancel()
+        dispatcher._release("held-1")
+        await asyncio.gather(waiter, return_exceptions=True)
+        dispatcher._release("held-2")
+
+    for _ in range(20):
+        on_loop(dispatcher, cycle())
+    assert active(dispatcher) == 0
+    assert not dispatcher._queues
+
+
+def test_caller_giving_up_in_queue_frees_its_place():
+    dispatcher = Dispatcher(1)
+    release = threading.Event()
+
+    def holder():
+        with dispatcher.slot("a"):
+            release.wait(5)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    time.sleep(0.1)
+
+    def give_up(position):
+        raise RuntimeError("rerun")
+
+    with pytest.raises(RuntimeError):
+        with dispatcher.slot("b", on_wait=give_up):
+            pass
+    release.set()
+    thread.join()
+    time.sleep(0.1)
+    assert active(dispatcher) == 0
+    with dispatcher.slot("b"):
+        assert active(dispatcher) == 1
+
+
+def test_users_are_served_round_robin():
+    dispatcher = Dispatcher(1)
+    order = []
+
+    async def run():
+        await dispatcher._acquire("holder", 0)
+        waiters = [
+            asyncio.ensure_future(dispatcher._acquire(user, ticket))
+            for ticket, user in enumerate(["a", "a", "a", "b"], start=1)
+        ]
+        await asyncio.sleep(0)
+        held = 0
+        for _ in waiters:
+            dispatcher._release(held)
+            await asyncio.sleep(0)
+            held = next(t for t in dispatcher._held)
+            order.append(held)
+        dispatcher._release(held)
+
+    on_loop(dispatcher, run())
+    assert order == [1, 4, 2, 3]
@@ -0,0 +1,110 @@
+"""Bounded conversation context for long dojo sessions.
+
+A persona chat normally resends its whole history on every message, so a
+45-minute session gets slower and dearer with each turn. RollingTranscript
+keeps only the most recent messages verbatim and folds older ones, a batch
+at a time, into a running summary that is updated incrementally (previous
+summary + newly folded messages). Folding runs in the background; once a new
+summary is ready the persona chat is rebuilt from summary + recent messages,
+so the prompt size per turn stays roughly constant.
+
+Messages are the app's chat_history entries: (speaker, text) pairs starting
+with the persona's opening line and alternating persona/therapist.
+"""
+import concurrent.futures
+import os
+
+import streamlit as st
+
+import ratelimit
+
+# Messages always kept verbatim at the end of the context
+CONTEXT_KEEP_TURNS = int(os.environ.get("CHRYSALIS_CONTEXT_KEEP_TURNS", "12"))
+# Messages folded at once, so the summary is not rewritten on every turn
+FOLD_BATCH = int(os.environ.get("CHRYSALIS_CONTEXT_FOLD_BATCH", "6"))
+SUMMARY_WORKERS = int(os.environ.get("CHRYSALIS_SUMMARY_WORKERS", "2"))
+
+THERAPIST = "Therapist"
+
+
+def format_turns(turns):
+    return "\n\n".join(f"{speaker}: {message}" for speaker, message in turns)
+
+
+class RollingTranscript:
+    """Running summary of the older part of one session's chat history."""
+
+    def __init__(self, keep_turns, token_budget):
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.summary = ""
+        # chat_history entries already covered by the summary
+        self.folded = 0
+        self._pending = None
+
+    def _tokens(self, turns):
+        return ratelimit.estimate_tokens(self.summary, format_turns(turns))
+
+    def _cut(self, history):
+        """Index where the verbatim part should start after the next fold."""
+        cut = max(self.folded, len(history) - self.keep_turns)
+        # Keep fewer messages verbatim if they alone blow the budget
+        while cut < len(history) - 2 and self._tokens(history[cut:]) > self.token_budget:
+            cut += 1
+        # Start on a persona line so the rebuilt chat alternates user/model
+        if cut % 2:
+            cut += 1
+        return min(cut, len(history) - 1)
+
+    def due(self, history):
+        cut = self._cut(history)
+        if cut <= self.folded:
+            return False
+        return cut - self.folded >= FOLD_BATCH or self._tokens(history[self.folded:]) > self.token_budget
+
+    def fold(self, history, summarize):
+        """Starts folding older messages in the background if it is time to.
+
+        summarize(previous_summary, turns) returns the updated summary text; it
+        runs on a worker thread, so it must not touch st.session_state.
+        """
+        if self._pending is not None or not self.due(history):
+            return
+        cut = self._cut(history)
+        previous, turns = self.summary, list(history[self.folded:cut])
+        self._pending = get_summary_pool().submit(lambda: (cut, summarize(previous, turns)))
+
+    def apply(self):
+        """Takes a finished fold. Returns True if the summary changed."""
+        if self._pending is None or not self._pending.done():
+            return False
+        pending, self._pending = self._pending, None
+        try:
+            self.folded, self.summary = pending.result()
+        except Exception:
+            # Keep the old summary; the fold is retried on a later turn
+            return False
+        return True
+
+    def chat_history(self, history):
+        """Gemini chat history: summary (if any) plus the verbatim messages."""
+        if self.summary:
+            opening = f"(The session began earlier. Summary of the conversation so far: {self.summary})"
+        else:
+            opening = "(The session begins.)"
+        return [{"role": "user", "parts": [opening]}] + [
+            {"role": "user" if speaker == THERAPIST else "model", "parts": [message]}
+            for speaker, message in history[self.folded:]
+        ]
+
+    def render(self, history):
+        """Transcript text for a prompt: full if it fits the budget, else summary + recent messages."""
+        full = format_turns(history)
+        if not self.summary or ratelimit.estimate_tokens(full) <= self.token_budget:
+            return full
+        return f"Summary of the earlier part of the session:\n{self.summary}\n\n{format_turns(history[self.folded:])}"
+
+
+@st.cache_resource
+def get_summary_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")